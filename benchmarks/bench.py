@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+'''
+Time the stages of the pipeline on a synthetic dataset, and compare them with a stored baseline.
+
+Each stage is run as its own process, so its wall time, CPU time and max RSS are measured alone.
+'''
+
+import asyncio
+import json
+import sys
+import tempfile
+from os import access, makedirs, path, X_OK
+from shutil import which
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from typing import Dict, List, Optional
+
+from benchmarks.synth import generate
+from utils import Pipeline, PipelineError
+from wdp.runner.profiler import format_bytes
+from wdp.util.formatter import ColorEnum, Component, Line, MultiLine
+
+CHIMERA = path.join(ROOT, "tools", "chimera-bin")
+
+
+class Bench():
+    '''
+    A benchmarked stage, the command reads the inputs and writes the output, all in the run directory.
+    '''
+
+    def __init__(self, name: str, inputs: List[str], output: str, command: List[str],
+                 stdout: bool = False, requires: Optional[str] = None) -> None:
+        self.name = name
+        self.inputs = inputs
+        self.output = output
+        self.command = command
+        self.stdout = stdout
+        self.requires = requires
+
+    def available(self) -> bool:
+        return self.requires is None or (which(self.requires) is not None if path.basename(self.requires) == self.requires
+                                         else access(self.requires, X_OK))
+
+    def run(self) -> dict:
+        pipeline = Pipeline(self.command, stdout=self.output if self.stdout else None, meter=False)
+        asyncio.run(pipeline.run())
+        stats = pipeline.stats[0]
+        size = sum(path.getsize(x) for x in self.inputs)
+        return {"wall": stats.elapsed,
+                "cpu": stats.user_time + stats.system_time,
+                "max_rss": stats.max_rss,
+                "input_bytes": size,
+                "throughput": size / max(stats.elapsed, 1e-6)}
+
+
+def stages(files: Dict[str, str], run_dir: str, samtools: str) -> List[Bench]:
+    python = sys.executable
+    uniq = path.join(run_dir, "mapped.uniq.pairs")
+    return [
+        Bench("uniq", [files["pairs"]], uniq,
+              [python, path.join(ROOT, "tools", "pairs.py"), files["pairs"], "-o", uniq]),
+        Bench("merge", [uniq], path.join(run_dir, "mapped.merged.pairs"),
+              [CHIMERA, "merge", "-i", uniq, "-e", 0, "--min", 10, "--max", 10000],
+              stdout=True, requires=CHIMERA),
+        Bench("annotate", [files["annotated"]], path.join(run_dir, "out.pairs"),
+              [python, path.join(ROOT, "tools", "merge.py"), files["annotated"], "-o", path.join(run_dir, "out.pairs")]),
+        Bench("quantificate", [uniq, files["alignments"]], path.join(run_dir, "depth.tsv"),
+              [python, path.join(ROOT, "tools", "coverage.py"), uniq, files["alignments"],
+               "-o", path.join(run_dir, "depth.tsv"), "--samtools", samtools, "--min-mapq", 0],
+              requires=samtools),
+    ]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    '''
+    The stages slower or larger than the baseline beyond the tolerance.
+    '''
+    regressions = []
+    for name, result in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            continue
+        for key in ("wall", "max_rss"):
+            if base[key] and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name} {key} {result[key] / base[key]:.2f}x of the baseline")
+    return regressions
+
+
+def summary(results: dict, baseline: Optional[dict]) -> MultiLine:
+    lines = MultiLine(Line(Component(f"{results['params']['reads']} read pairs", ColorEnum.BOLD)))
+    for name, result in results["stages"].items():
+        line = Line(Component(name, ColorEnum.BOLD),
+                    Component(f": {result['wall']:.2f}s, cpu {result['cpu']:.2f}s, max rss {format_bytes(result['max_rss'])}, "
+                              f"{format_bytes(result['throughput'])}/s"))
+        base = (baseline or {}).get("stages", {}).get(name)
+        if base is not None:
+            ratio = result["wall"] / max(base["wall"], 1e-6)
+            line.append(Component(f", {ratio:.2f}x of the baseline",
+                                  ColorEnum.FOREGROUND_RED if ratio > 1 else ColorEnum.FOREGROUND_GREEN))
+        lines.append(MultiLine(line, ident=1))
+    return lines
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="benchmark the pipeline stages on a synthetic dataset")
+    parser.add_argument("-n", "--reads", type=int, default=10000, help="the read pairs, from 10k up to 100M")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=None, help="where the dataset is generated and kept across runs")
+    parser.add_argument("--stages", default=None, help="the stages to run, separated by commas")
+    parser.add_argument("--repeat", type=int, default=3, help="run each stage this many times and keep the fastest")
+    parser.add_argument("--samtools", default="samtools", help="the samtools binary path")
+    parser.add_argument("--baseline", default=path.join(path.dirname(path.abspath(__file__)), "baseline.json"),
+                        help="the baseline to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="the slowdown flagged as a regression")
+    parser.add_argument("-o", "--output", default=None, help="write the results as JSON")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or path.join(tempfile.gettempdir(), "catk-bench", f"n{args.reads}-s{args.seed}")
+    print(f"Generating the dataset in {data_dir}")
+    files = generate(data_dir, reads=args.reads, seed=args.seed)
+    run_dir = path.join(data_dir, "run")
+    makedirs(run_dir, exist_ok=True)
+
+    wanted = args.stages.split(",") if args.stages else None
+    results = {"params": {"reads": args.reads, "seed": args.seed}, "stages": {}}
+    for bench in stages(files, run_dir, args.samtools):
+        if wanted is not None and bench.name not in wanted:
+            continue
+        if not bench.available():
+            print(f"Skipping {bench.name}, {bench.requires} is not found.")
+            continue
+        try:
+            runs = [bench.run() for _ in range(max(args.repeat, 1))]
+        except PipelineError as e:
+            print(f"Stage {bench.name} failed, {e}")
+            continue
+        best = min(runs, key=lambda x: x["wall"])
+        best["max_rss"] = max(x["max_rss"] for x in runs)
+        results["stages"][bench.name] = best
+
+    baseline = None
+    if path.isfile(args.baseline) and not args.save_baseline:
+        baseline = json.load(open(args.baseline))
+        if baseline["params"] != results["params"]:
+            print(f"The baseline is of {baseline['params']}, not comparable.")
+            baseline = None
+    print(summary(results, baseline))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+    elif baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for x in regressions:
+            print(f"Regression: {x}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+'''
+Deterministic synthetic data for the benchmarks: a toy genome with its genes,
+and read pairs with back-splice junctions planted in them.
+
+The intermediate files of the pipeline are generated along with the reads,
+so the python stages can be benchmarked without running the aligner.
+'''
+
+import json
+import sys
+from os import makedirs, path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from typing import Dict, List
+
+import numpy as np
+
+from tools.pairs import format_ints
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+COMPLEMENT = np.zeros(256, dtype=np.uint8)
+COMPLEMENT[np.frombuffer(b"ACGTN", dtype=np.uint8)] = np.frombuffer(b"TGCAN", dtype=np.uint8)
+
+
+def column(values: np.ndarray) -> np.ndarray:
+    '''
+    A column as an (n, width) array of ascii, padded by nulls.
+    '''
+    if values.ndim == 2:
+        return values
+    if values.dtype.kind == "S":
+        return values.view(np.uint8).reshape(len(values), values.dtype.itemsize)
+    return format_ints(values)
+
+
+def render(*parts) -> bytes:
+    '''
+    Lay the parts side by side into lines, each part is either constant bytes or a column.
+    '''
+    n = next(len(x) for x in parts if isinstance(x, np.ndarray))
+    blocks = [np.broadcast_to(np.frombuffer(x, dtype=np.uint8), (n, len(x))) if isinstance(x, bytes) else column(x)
+              for x in parts]
+    table = np.concatenate(blocks, axis=1)
+    return table[table != 0].tobytes()
+
+
+def reverse_complement(seqs: np.ndarray) -> np.ndarray:
+    return COMPLEMENT[seqs[:, ::-1]]
+
+
+class Genome():
+    '''
+    Random chromosomes, and genes of a few exons on them.
+    '''
+
+    def __init__(self, rng: np.random.Generator, chromosomes: int, length: int, genes: int) -> None:
+        self.names = np.array([f"chr{i + 1}".encode() for i in range(chromosomes)])
+        self.seqs = BASES[rng.integers(0, 4, size=(chromosomes, length), dtype=np.uint8)]
+
+        self.genes: List[dict] = []
+        for i in range(genes):
+            exons = int(rng.integers(2, 11))
+            lengths = rng.integers(80, 400, size=exons)
+            introns = rng.integers(200, 3000, size=exons - 1)
+            span = int(lengths.sum() + introns.sum())
+            start = int(rng.integers(1000, length - span - 1000))
+            starts = start + np.append(0, np.cumsum(lengths[:-1] + introns))
+            self.genes.append({"name": f"g{i + 1}",
+                               "chr": int(rng.integers(0, chromosomes)),
+                               "strand": "+" if rng.random() < 0.5 else "-",
+                               "starts": starts,
+                               "ends": starts + lengths})
+
+    def write_fasta(self, fasta: str, width: int = 60):
+        with open(fasta, "wb") as f:
+            for name, seq in zip(self.names, self.seqs):
+                f.write(b">" + name + b"\n")
+                full = len(seq) // width * width
+                f.write(render(seq[:full].reshape(-1, width), b"\n"))
+                if full < len(seq):
+                    f.write(seq[full:].tobytes() + b"\n")
+
+    def write_genepred(self, genepred: str):
+        with open(genepred, "w") as f:
+            for gene in self.genes:
+                starts, ends = gene["starts"].tolist(), gene["ends"].tolist()
+                f.write(f"{gene['name']}\t{gene['name']}.1\t{self.names[gene['chr']].decode()}\t{gene['strand']}\t"
+                        f"{starts[0]}\t{ends[-1]}\t{starts[0]}\t{ends[-1]}\t{len(starts)}\t"
+                        f"{','.join(map(str, starts))},\t{','.join(map(str, ends))},\n")
+
+
+class Circles():
+    '''
+    The planted circRNAs, each one back-spliced from the end of an exon to the start of an earlier one.
+    '''
+
+    def __init__(self, rng: np.random.Generator, genome: Genome, count: int) -> None:
+        picked = rng.integers(0, len(genome.genes), size=count)
+        self.chrs = np.empty(count, dtype=np.int64)
+        self.starts = np.empty(count, dtype=np.int64)
+        self.ends = np.empty(count, dtype=np.int64)
+        for i, g in enumerate(picked.tolist()):
+            gene = genome.genes[g]
+            first, last = np.sort(rng.integers(0, len(gene["starts"]), size=2))
+            self.chrs[i] = gene["chr"]
+            self.starts[i] = gene["starts"][first]
+            self.ends[i] = gene["ends"][last]
+        # a few circRNAs take most of the reads
+        weights = 1 / np.arange(1, count + 1) ** 0.8
+        self.weights = rng.permutation(weights / weights.sum())
+
+
+def sample_reads(rng: np.random.Generator, genome: Genome, circles: Circles, first: int, count: int,
+                 read_length: int, bsj_fraction: float) -> Dict[str, np.ndarray]:
+    '''
+    Sample the read pairs, the back-splice ones span the junction with their first mate.
+    '''
+    ids = np.arange(first, first + count, dtype=np.int64)
+    bsj = rng.random(count) < bsj_fraction
+    circle = np.where(bsj, rng.choice(len(circles.weights), size=count, p=circles.weights), -1)
+    chrs = np.where(bsj, circles.chrs[np.maximum(circle, 0)], rng.integers(0, len(genome.names), size=count))
+
+    # linear fragments anywhere, mate 2 is the reverse complement of the other end
+    length = genome.seqs.shape[1]
+    pos1 = rng.integers(0, length - 400 - read_length, size=count)
+    pos2 = pos1 + rng.integers(150, 400, size=count)
+    # back-splice fragments, the first `clip` bases of mate 1 are from the junction end
+    clip = rng.integers(10, read_length - 10, size=count)
+    ends, starts = circles.ends[np.maximum(circle, 0)], circles.starts[np.maximum(circle, 0)]
+    pos1 = np.where(bsj, ends - clip, pos1)
+    pos2 = np.where(bsj, starts + rng.integers(0, 50, size=count), pos2)
+
+    offsets = np.arange(read_length)
+    mate1 = genome.seqs[chrs[:, None], pos1[:, None] + offsets]
+    # the part past the junction comes from the start of the circle
+    spliced = offsets[None, :] >= clip[:, None]
+    joined = genome.seqs[chrs[:, None], (starts - clip)[:, None] + offsets]
+    mate1 = np.where(bsj[:, None] & spliced, joined, mate1)
+    mate2 = reverse_complement(genome.seqs[chrs[:, None], pos2[:, None] + offsets])
+    return {"ids": ids, "bsj": bsj, "circle": circle, "chrs": chrs, "pos1": pos1, "pos2": pos2, "clip": clip,
+            "junction": starts, "mate1": mate1, "mate2": mate2}
+
+
+def write_fastq(f, names: np.ndarray, seqs: np.ndarray, mate: bytes):
+    quals = np.full(seqs.shape, ord("I"), dtype=np.uint8)
+    f.write(render(b"@r", names, b"/" + mate + b"\n", seqs, b"\n+\n", quals, b"\n"))
+
+
+def write_sam(f, genome: Genome, reads: Dict[str, np.ndarray], read_length: int):
+    '''
+    The alignments as bwa would report them, a back-splice mate is split into a primary and a supplementary one.
+    '''
+    names, chrs, clip = reads["ids"], genome.names[reads["chrs"]], reads["clip"]
+    bsj = reads["bsj"]
+    linear = ~bsj
+    full = f"{read_length}M".encode()
+    f.write(render(b"r", names[linear], b"\t99\t", chrs[linear], b"\t", reads["pos1"][linear] + 1,
+                   b"\t60\t" + full + b"\t=\t", reads["pos2"][linear] + 1, b"\t0\t*\t*\n"))
+    f.write(render(b"r", names, b"\t147\t", chrs, b"\t", reads["pos2"] + 1,
+                   b"\t60\t" + full + b"\t=\t", reads["pos1"] + 1, b"\t0\t*\t*\n"))
+    if bsj.any():
+        clip = clip[bsj]
+        rest = read_length - clip
+        f.write(render(b"r", names[bsj], b"\t65\t", chrs[bsj], b"\t", reads["pos1"][bsj] + 1, b"\t60\t",
+                       clip, b"M", rest, b"S\t=\t", reads["pos2"][bsj] + 1, b"\t0\t*\t*\n"))
+        f.write(render(b"r", names[bsj], b"\t2113\t", chrs[bsj], b"\t", reads["junction"][bsj] + 1, b"\t60\t",
+                       clip, b"S", rest, b"M\t=\t", reads["pos2"][bsj] + 1, b"\t0\t*\t*\n"))
+
+
+def generate(out_dir: str, reads: int = 10000, seed: int = 0, chromosomes: int = 8, chromosome_length: int = 1_000_000,
+             genes: int = 2000, circles: int = 5000, read_length: int = 100, bsj_fraction: float = 0.05,
+             chunk: int = 1 << 20) -> dict:
+    '''
+    Generate the dataset into the directory, it's skipped if the one there has the same parameters.
+
+    Returns the paths of the files generated.
+    '''
+    params = {"reads": reads, "seed": seed, "chromosomes": chromosomes, "chromosome_length": chromosome_length,
+              "genes": genes, "circles": circles, "read_length": read_length, "bsj_fraction": bsj_fraction}
+    files = {x: path.join(out_dir, y) for x, y in (("genome", "genome.fa"), ("genes", "genes.gp"),
+                                                    ("fq1", "reads.1.fq"), ("fq2", "reads.2.fq"),
+                                                    ("pairs", "mapped.pairs"), ("annotated", "annotated.txt"),
+                                                    ("alignments", "mapped.sam"), ("truth", "circles.tsv"))}
+    manifest = path.join(out_dir, "synth.json")
+    if path.isfile(manifest) and json.load(open(manifest)) == {"params": params, "files": files}:
+        return files
+    makedirs(out_dir, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    genome = Genome(rng, chromosomes, chromosome_length, genes)
+    planted = Circles(rng, genome, circles)
+    genome.write_fasta(files["genome"])
+    genome.write_genepred(files["genes"])
+
+    depth = np.zeros(circles, dtype=np.int64)
+    with open(files["fq1"], "wb") as fq1, open(files["fq2"], "wb") as fq2, \
+            open(files["pairs"], "wb") as pairs, open(files["alignments"], "wb") as sam:
+        sam.write(b"@HD\tVN:1.6\n")
+        for name, seq in zip(genome.names, genome.seqs):
+            sam.write(b"@SQ\tSN:%s\tLN:%d\n" % (name, len(seq)))
+        for first in range(0, reads, chunk):
+            # seeded by the chunk, so the reads do not depend on the chunk size of a previous run
+            sampled = sample_reads(np.random.default_rng([seed, first]), genome, planted, first,
+                                   min(chunk, reads - first), read_length, bsj_fraction)
+            write_fastq(fq1, sampled["ids"], sampled["mate1"], b"1")
+            write_fastq(fq2, sampled["ids"], sampled["mate2"], b"2")
+            write_sam(sam, genome, sampled, read_length)
+
+            # both mates of some pairs report the junction, which the dedup has to drop
+            bsj = sampled["bsj"]
+            twice = np.repeat(np.flatnonzero(bsj), np.where(np.random.default_rng([seed, first, 1]).random(bsj.sum()) < 0.3, 2, 1))
+            circle = sampled["circle"][twice]
+            pairs.write(render(genome.names[planted.chrs[circle]], b"\t", planted.starts[circle], b"\t",
+                               planted.ends[circle], b"\tr", sampled["ids"][twice], b"\n"))
+            depth += np.bincount(sampled["circle"][bsj], minlength=circles)
+
+    # annotate reports the junctions near the same exons as the same hit, once for each
+    rows = np.repeat(np.arange(circles), rng.integers(1, 5, size=circles))
+    with open(files["annotated"], "wb") as f:
+        f.write(render(genome.names[planted.chrs[rows]], b"\t", planted.starts[rows], b"\t", planted.ends[rows],
+                       b"\tEXON_2\t+\t", planted.starts[rows], b"\t", planted.ends[rows], b"\t",
+                       rng.integers(1, 50, size=len(rows)), b"\n"))
+    with open(files["truth"], "wb") as f:
+        f.write(render(genome.names[planted.chrs], b"\t", planted.starts, b"\t", planted.ends, b"\t", depth, b"\n"))
+
+    with open(manifest, "w") as f:
+        json.dump({"params": params, "files": files}, f, indent=2)
+    return files
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="generate a synthetic circRNA dataset")
+    parser.add_argument("out_dir", help="the directory to write into")
+    parser.add_argument("-n", "--reads", type=int, default=10000, help="the read pairs to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chromosomes", type=int, default=8)
+    parser.add_argument("--chromosome-length", type=int, default=1_000_000)
+    parser.add_argument("--genes", type=int, default=2000)
+    parser.add_argument("--circles", type=int, default=5000)
+    parser.add_argument("--read-length", type=int, default=100)
+    parser.add_argument("--bsj-fraction", type=float, default=0.05,
+                        help="the fraction of read pairs spanning a back-splice junction")
+    args = vars(parser.parse_args())
+    for k, v in generate(args.pop("out_dir"), **args).items():
+        print(f"{k}\t{v}")
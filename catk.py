@@ -1,7 +1,17 @@
-from wdp.cli.cli import commands
-import cmds  # pylint:disable-unused-imports
+from wdp.cli.cli import commands, lazy
 import asyncio
 
+# The commands are defined in cmds, which is imported only when one of them is selected.
+lazy("all", "cmds", "run the complete pipeline")
+lazy("batch", "cmds", "align, annotate and assemble every sample in a sample sheet")
+lazy("index", "cmds", "build the bwa index of a reference into the shared index store")
+lazy("align", "cmds", "map the reads to the reference genome with bwa and chimera")
+lazy("annotate", "cmds", "annotate the alignments by a reference genes list")
+lazy("parse", "cmds", "parse the alignment with chimera")
+lazy("assemble", "cmds", "assemble the circRNA transcriptome by the result of align")
+lazy("salvage", "cmds", None)
+lazy("quantificate", "cmds", "estimate the sequencing depth of each circRNA sequence")
+
 
 if __name__ == "__main__":
     (asyncio
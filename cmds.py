@@ -1,9 +1,19 @@
-from groups import AlignArgs, AlignInputArgs, AnnotateArgs, AnnotateInputArgs, AssembleArgs, AssembleInputArgs, ParseArgs, QuantificateArgs, UniversalArgs
-from utils import async_system
+from groups import AlignArgs, AlignInputArgs, AnnotateArgs, AnnotateInputArgs, AssembleArgs, AssembleInputArgs, BatchInputArgs, IndexArgs, IndexInputArgs, ParseArgs, QuantificateArgs, QuantificateInputArgs, UniversalArgs, throw_if_no_binary
+from utils import async_pipeline, bwa_index_files
 from wdp.cli.cli import command
+from wdp.cli.model import Arg
+from wdp.collector.concrete.str import Str
+from wdp.runner.cache import partial
 from wdp.runner.model import Runnable, Conditional
+from wdp.runner.allocator import granted_memory
+from wdp.runner.profiler import run_in_thread, total_size
+from wdp.runner.scheduler import Scheduler
+from wdp.util.formatter import ColorEnum, Component, Line, MultiLine
 
 from os import path, makedirs
+import asyncio
+import shutil
+import sys
 
 
 @command("all")
@@ -12,14 +22,112 @@ class All(Runnable):
     run the complete pipeline
     '''
 
+    input = AlignInputArgs
     universal = UniversalArgs
     align = AlignArgs
+    index = IndexArgs
     parse = ParseArgs
     assemble = AssembleArgs
     quantificate = QuantificateArgs
 
     async def run(self):
-        return await super().run()
+        throw_if_no_binary(self.align.bwa_binary, self.parse.samtools_binary, self.assemble.soapdenovo_binary)
+        self.universal.manifest()
+        self.align.manifest()
+        self.assemble.manifest()
+        self.quantificate.manifest()
+
+        db = self.input.db
+        if not self.input.prefix:
+            with self.universal.profiler().stage("index", inputs=[db]):
+                db = await self.index.store().ensure(db, self.align.bwa_binary)
+
+        # The stages of all commands are put into a single graph,
+        # so the independent ones can overlap across the commands.
+        scheduler = self.universal.scheduler()
+        uniq_pairs, chimeric_sam, mapped_fq1, mapped_fq2 = Align().plan(scheduler, self.align.align_dir,
+                                                                        self.input.fq1, self.input.fq2, db)
+        Assemble().plan(scheduler, self.assemble.assemble_dir, chimeric_sam, mapped_fq1, mapped_fq2 or "")
+        Quantificate().plan(scheduler, self.quantificate.quantificate_dir, uniq_pairs,
+                            path.join(self.align.align_dir, "mapped.bam"))
+        return await scheduler.run()
+
+
+@command("batch")
+class Batch(Runnable):
+    '''
+    align, annotate and assemble every sample in a sample sheet,
+    the samples share the reference index and a single pool of threads
+    '''
+
+    input = BatchInputArgs
+    universal = UniversalArgs
+    align = AlignArgs
+    index = IndexArgs
+    parse = ParseArgs
+    assemble = AssembleArgs
+
+    async def run(self):
+        throw_if_no_binary(self.align.bwa_binary, self.parse.samtools_binary,
+                           *([] if self.input.skip_assemble else [self.assemble.soapdenovo_binary]))
+        self.universal.manifest()
+        samples = self.input.sheet()
+
+        db = self.input.db
+        if not self.input.prefix:
+            with self.universal.profiler().stage("index", inputs=[db]):
+                db = await self.index.store().ensure(db, self.align.bwa_binary)
+
+        threads = self.universal.threads
+        max_samples = self.input.max_samples or max(1, threads // 8)
+        scheduler = Scheduler(threads, cache=self.universal.cache(), max_groups=max_samples,
+                              profiler=self.universal.profiler(), scratch=self.universal.scratch(),
+                              memory=self.universal.memory_budget())
+
+        outputs = {}
+        for sample, fq1, fq2 in samples:
+            sample_dir = path.join(self.universal.work_dir.inner, sample)
+            align_dir, annotate_dir, assemble_dir = (path.join(sample_dir, x) for x in ("align", "annotate", "assemble"))
+            for x in (align_dir, annotate_dir, assemble_dir):
+                makedirs(x, exist_ok=True)
+
+            # a sample never takes more than its share of the threads
+            group = scheduler.group(sample, threads=max(1, threads // max_samples))
+            uniq_pairs, chimeric_sam, mapped_fq1, mapped_fq2 = Align().plan(group, align_dir, fq1, fq2, db)
+            outputs[sample] = {"pairs": uniq_pairs}
+            if self.input.reference:
+                outputs[sample]["hits"] = Annotate().plan(group, annotate_dir, uniq_pairs, self.input.reference,
+                                                          self.input.annotate_extend)
+            if not self.input.skip_assemble:
+                outputs[sample]["scaffolds"] = Assemble().plan(group, assemble_dir, chimeric_sam,
+                                                               mapped_fq1, mapped_fq2 or "")
+
+        await scheduler.run()
+        return outputs
+
+
+@command("index")
+class Index(Runnable):
+    '''
+    build the bwa index of a reference into the shared index store,
+    align and assemble will then reuse it instead of indexing again
+    '''
+
+    input = IndexInputArgs
+    index = IndexArgs
+
+    bwa_binary = Arg(required=False,
+                     help="the bwa binary path",
+                     meta="STR",
+                     long="bwa-binary",
+                     default="bwa"
+                     ).field(Str().unwrapped())
+
+    async def run(self):
+        throw_if_no_binary(self.bwa_binary)
+        prefix = await self.index.store().ensure(self.input.reference, self.bwa_binary)
+        print(prefix)
+        return prefix
 
 
 @command("align")
@@ -31,61 +139,176 @@ class Align(Runnable):
     input = AlignInputArgs
     universal = UniversalArgs
     align = AlignArgs
+    index = IndexArgs
     parse = ParseArgs
 
     async def run(self):
+        throw_if_no_binary(self.align.bwa_binary, self.parse.samtools_binary)
         self.universal.manifest()
         self.align.manifest()
 
-        min_len, max_len = map(int, self.parse.filter_length.split(","))
-
         if not self.input.prefix:
-            # build the bwa index
-            prefix = path.join(self.align.align_dir, "db")
-            await async_system(f"\"{self.align.bwa_binary}\" index -p {prefix} {self.input.db}")
-            self.input.db = prefix
+            # reuse or build the bwa index in the shared store
+            with self.universal.profiler().stage("align.index", inputs=[self.input.db]):
+                self.input.db = await self.index.store().ensure(self.input.db, self.align.bwa_binary)
+
+        scheduler = self.universal.scheduler()
+        out_sorted_pairs, _, mapped_fq1, mapped_fq2 = self.plan(scheduler, self.align.align_dir,
+                                                                self.input.fq1, self.input.fq2, self.input.db)
+        await scheduler.run()
+        return out_sorted_pairs, mapped_fq1, mapped_fq2
+
+    def plan(self, scheduler: Scheduler, align_dir: str, fq1: str, fq2: str, db: str):
+        '''
+        Add the aligning stages to the scheduler, `db` must be the prefix of a bwa index.
 
-        mapped_fq1 = path.join(self.align.align_dir, "mapped.1.fq")
-        mapped_fq2 = path.join(self.align.align_dir, "mapped.2.fq") if self.input.fq2 else None
+        Returns the paths to the uniq pairs, the chimeric reads and the overlapped reads.
+        '''
+        throw_if_no_binary(self.align.bwa_binary, self.parse.samtools_binary)
+        min_len, max_len = map(int, self.parse.filter_length.split(","))
 
-        _fq2 = f' \"{self.input.fq2}\"' if self.input.fq2 else ''
+        # the intermediates are put on the scratch, and deleted once read unless they are kept,
+        # the ones read once as a stream are piped to the stage reading them
+        scratch = self.universal.scratch()
+        mapped_fq1 = scratch.temp(self.universal.intermediate(path.join(align_dir, "mapped.1.fq")))
+        mapped_fq2 = scratch.temp(self.universal.intermediate(path.join(align_dir, "mapped.2.fq"))) if fq2 else None
 
-        out_bam = path.join(self.align.align_dir, "mapped.bam")
-        chimeric_sam = path.join(self.align.align_dir, "chimeric.sam")
-        out_pairs = path.join(self.align.align_dir, "mapped.pairs")
-        out_sorted_pairs = path.join(self.align.align_dir, "mapped.uniq.pairs")
-        out_merged_pairs = path.join(self.align.align_dir, "mapped.merged.pairs")
+        out_bam = path.join(align_dir, "mapped.bam")
+        chimeric_sam = scratch.pipe(path.join(align_dir, "chimeric.sam"))
+        out_sorted_pairs = path.join(align_dir, "mapped.uniq.pairs")
+        out_merged_pairs = scratch.temp(path.join(align_dir, "mapped.merged.pairs"))
+        from tools.fastq import BWA_BATCH_BASES, is_gzipped, write_ranges
 
         # bwa mem | samtools view -q 30 | chimera-bin | samtools view -bS
         # No penalty on pair mismatch and 5/3 end clipping
         # Recover some of the suppressed alignment
         # This is for junction reads' features.
-        await async_system(f"\"{self.align.bwa_binary}\""
-                           f" mem -L0 -t {self.universal.threads} -k {self.align.seed_length} "
-                           f"\"{self.input.db}\" \"{self.input.fq1}\""
-                           f"{_fq2}"
-                           f'| \"{self.parse.samtools_binary}\" view -Sh -q 30 - '
-                           f'| \"{self.parse.chimera_binary}\" chimera -p \"{out_pairs}\" -o \"{chimeric_sam}\"'
-                           f'| \"{self.parse.samtools_binary}\" view -bS '
-                           f"-@ {self.universal.threads} - "
-                           f'> \"{out_bam}\"')
-
-        # sort | uniq | tee | chimera merge
-        await async_system(f"sort \"{out_pairs}\" "
-                           f"| python3 \"{self.parse.uniq_binary}\""
-                           f"| tee \"{out_sorted_pairs}\""
-                           f"| \"{self.parse.chimera_binary}\" merge"
-                           f" -e {self.parse.extend_length} --min {min_len} --max {max_len} "
-                           f"> \"{out_merged_pairs}\"")
+        # the threads are split between bwa and the BAM compression, the others in the pipe take one,
+        # bwa reads a fixed number of bases per batch, so the split doesn't change the alignments
+        def mem(threads: int, reads: list, pairs: str, sam: str, bam: str, *source):
+            allocation = self.universal.allocator().split(threads, ["bwa", "samtools"])
+            return async_pipeline(
+                *source,
+                [self.align.bwa_binary, "mem", "-L0", "-K", BWA_BATCH_BASES, "-t", allocation["bwa"],
+                 "-k", self.align.seed_length]
+                + (["-p"] if source and fq2 else []) + [db] + reads,
+                [self.parse.samtools_binary, "view", "-Sh", "-q", 30, "-"],
+                [self.parse.chimera_binary, "chimera", "-p", partial(pairs), "-o", partial(sam)],
+                [self.parse.samtools_binary, "view", "-bS", "-@", allocation["samtools"], "-"],
+                stdout=partial(bam))
+
+        params = {"bwa": self.align.bwa_binary,
+                  "samtools": self.parse.samtools_binary,
+                  "seed_length": self.align.seed_length,
+                  "batch_bases": BWA_BATCH_BASES}
+        # bwa loads the whole index, each shard its own
+        mem_memory = lambda size: total_size(bwa_index_files(db)) + (1 << 30)
+        shards = self.align.shards or max(1, (scheduler.threads or self.universal.threads) // 16)
+        if shards > 1 and any(is_gzipped(x) for x in (fq1, fq2) if x):
+            print("The reads are gzipped and can't be split by their offsets, aligning them in one shard.")
+            shards = 1
+
+        if shards == 1:
+            out_pairs = [scratch.pipe(path.join(align_dir, "mapped.pairs"))]
+            scheduler.add("align.mem",
+                          lambda threads: mem(threads, [fq1] + ([fq2] if fq2 else []), out_pairs[0], chimeric_sam, out_bam),
+                          inputs=bwa_index_files(db) + [fq1, fq2],
+                          outputs=[out_bam, chimeric_sam, out_pairs[0]],
+                          threads=self.universal.threads,
+                          memory=mem_memory,
+                          params=params)
+        else:
+            # the shards read their ranges of the reads in place, and are aligned as separate pipelines,
+            # as neither bwa past some 32 threads nor chimera-bin keep up with a single one,
+            # the ranges are cut between the batches of `bwa mem -K`, so the shards read the same batches
+            ranges = scratch.temp(path.join(align_dir, "shards.json"))
+            reads = [fq1] + ([fq2] if fq2 else [])
+
+            async def split(threads: int):
+                await run_in_thread(write_ranges, reads, shards, partial(ranges), BWA_BATCH_BASES)
+
+            scheduler.add("align.split", split,
+                          inputs=reads,
+                          outputs=[ranges],
+                          params={"shards": shards, "batch_bases": BWA_BATCH_BASES})
+
+            out_pairs, shard_sams, shard_bams = [], [], []
+            for shard in range(shards):
+                out_pairs.append(scratch.temp(path.join(align_dir, f"mapped.{shard}.pairs")))
+                shard_sams.append(scratch.temp(path.join(align_dir, f"chimeric.{shard}.sam")))
+                shard_bams.append(scratch.temp(path.join(align_dir, f"mapped.{shard}.bam")))
+                scheduler.add(f"align.mem.{shard}",
+                              lambda threads, shard=shard: mem(
+                                  threads, ["-"], out_pairs[shard], shard_sams[shard], shard_bams[shard],
+                                  [sys.executable, self.align.fastq_binary, "read", "-r", ranges, "-s", shard] + reads),
+                              inputs=bwa_index_files(db) + reads + [ranges],
+                              outputs=[shard_bams[shard], shard_sams[shard], out_pairs[shard]],
+                              threads=max(1, self.universal.threads // shards),
+                              memory=mem_memory,
+                              params={**params, "shard": shard})
+
+            # the shards read the same batches as a single bwa and are concatenated in order,
+            # so the alignments are as if aligned at once, but for the ties bwa breaks by the index of a read,
+            # those between hits of the same score, which get a MAPQ of 0 and are dropped by `-q 30`
+            async def gather(threads: int):
+                from tools.fastq import concat_sam
+                await asyncio.gather(
+                    async_pipeline([self.parse.samtools_binary, "cat", "-o", partial(out_bam)] + shard_bams),
+                    run_in_thread(concat_sam, shard_sams, partial(chimeric_sam)))
+
+            scheduler.add("align.gather", gather,
+                          inputs=shard_bams + shard_sams,
+                          outputs=[out_bam, chimeric_sam],
+                          params={"samtools": self.parse.samtools_binary})
+
+        # dedup in process | chimera merge, or merged in process too
+        merge_by_chimera = self.parse.merge_by_chimera()
+
+        # the unique reads take some 96 bytes each while counted, and are spilled to disk beyond the memory granted
+        row_memory, max_rows = 96, 1 << 25
+
+        async def merge(threads: int):
+            from tools.pairs import dedup_pairs
+            sorted_pairs = partial(out_sorted_pairs)
+            rows = max(granted_memory(row_memory * max_rows) // row_memory, 1 << 16)
+            await run_in_thread(dedup_pairs, out_pairs, sorted_pairs, rows, path.dirname(out_pairs[0]))
+            if not merge_by_chimera:
+                from tools.regions import merge_regions
+                merged = await run_in_thread(merge_regions, [sorted_pairs], partial(out_merged_pairs), min_len, max_len)
+                print(f"Merged {merged} regions.")
+                return
+            return await async_pipeline([self.parse.chimera_binary, "merge", "-i", sorted_pairs,
+                                         "-e", self.parse.extend_length, "--min", min_len, "--max", max_len],
+                                        stdout=partial(out_merged_pairs))
+
+        scheduler.add("align.merge", merge,
+                      inputs=out_pairs,
+                      outputs=[out_sorted_pairs, out_merged_pairs],
+                      # the pairs piped in are of an unknown size
+                      memory=lambda size: min(3 * size, row_memory * max_rows) if size else row_memory * max_rows,
+                      params={"extend_length": self.parse.extend_length,
+                              "filter_length": self.parse.filter_length,
+                              "merge_backend": "chimera" if merge_by_chimera else "numpy"})
 
         # samtools view | chimera overlap | samtools fastq
-        _fqoutput = f"-1 \"{mapped_fq1}\" -2 \"{mapped_fq2}\"" if self.input.fq2 else f"> \"{mapped_fq1}\""
-        await async_system(f"\"{self.parse.samtools_binary}\" view -Sh \"{out_bam}\""
-                           f"| \"{self.parse.chimera_binary}\" overlap -a \"{out_merged_pairs}\""
-                           f"| \"{self.parse.samtools_binary}\" fastq - "
-                           f"{_fqoutput}")
-
-        return out_sorted_pairs, mapped_fq1, mapped_fq2
+        # samtools compresses the paired reads by their names, the single end ones are piped to the compressor
+        level = self.universal.compress_intermediates
+        scheduler.add("align.overlap",
+                      lambda threads: async_pipeline(
+                          [self.parse.samtools_binary, "view", "-Sh", out_bam],
+                          [self.parse.chimera_binary, "overlap", "-a", out_merged_pairs],
+                          [self.parse.samtools_binary, "fastq", "-"]
+                          + (["-c", level, "-@", threads] if level and fq2 else [])
+                          + (["-1", partial(mapped_fq1), "-2", partial(mapped_fq2)] if fq2 else []),
+                          *([self.universal.compressor(threads)] if level and not fq2 else []),
+                          stdout=None if fq2 else partial(mapped_fq1)),
+                      inputs=[out_bam, out_merged_pairs],
+                      outputs=[mapped_fq1, mapped_fq2],
+                      threads=min(self.universal.threads, 4) if level else 1,
+                      params={"samtools": self.parse.samtools_binary,
+                              "compress_intermediates": level})
+
+        return out_sorted_pairs, chimeric_sam, mapped_fq1, mapped_fq2
 
 
 @command("annotate")
@@ -103,19 +326,86 @@ class Annotate(Runnable):
     async def run(self):
         self.input.manifest()
 
+        scheduler = self.universal.scheduler()
+        out_hits = self.plan(scheduler, self.input.annotate_dir, self.input.juncs, self.input.reference,
+                             self.annotate.extend_length, self.annotate.edge, self.annotate.single,
+                             self.annotate.shards)
+        await scheduler.run()
+        return out_hits
+
+    def plan(self, scheduler: Scheduler, annotate_dir: str, juncs: str, reference: str,
+             extend_length: int, edge: bool = False, single: bool = False, shards: int = 0):
+        '''
+        Add the annotating stages to the scheduler, the junctions are split by chromosome into `shards`.
+
+        Returns the path to the annotated hits.
+        '''
         flags = []
-        if self.annotate.edge:
+        if edge:
             flags.append("--edge")
-        if self.annotate.single:
+        if single:
             flags.append("--single")
-
-        out_hits = path.join(self.input.annotate_dir, "out.pairs")
-        await async_system(f"\"{self.annotate.chimera_binary}\" annotate "
-                           f"-e {self.annotate.extend_length} "
-                           f"-j \"{self.input.juncs}\" -r \"{self.input.reference}\" "
-                           f"{' '.join(flags)} "
-                           f"| python3 \"{self.annotate.merge_binary}\" "
-                           f"> \"{out_hits}\"")
+        params = {"extend_length": extend_length, "edge": edge, "single": single}
+
+        def annotate(juncs: str, reference: str, hits: str):
+            return async_pipeline(
+                [self.annotate.chimera_binary, "annotate", "-e", extend_length,
+                 "-j", juncs, "-r", reference] + flags,
+                [sys.executable, self.annotate.merge_binary, "-o", partial(hits)])
+
+        out_hits = path.join(annotate_dir, "out.pairs")
+        # chimera-bin holds the junctions and the genes given
+        annotate_memory = lambda size: 4 * size + (256 << 20)
+        shards = shards or min(scheduler.threads or self.universal.threads, 16)
+        if shards == 1:
+            scheduler.add("annotate.chimera",
+                          lambda threads: annotate(juncs, reference, out_hits),
+                          inputs=[juncs, reference],
+                          outputs=[out_hits],
+                          memory=annotate_memory,
+                          params=params)
+            return out_hits
+
+        # chimera-bin holds the exon boundaries of all the genes it's given,
+        # so each shard only gets the genes on the chromosomes of its junctions
+        scratch = self.universal.scratch()
+        shard_juncs = [scratch.temp(path.join(annotate_dir, f"juncs.{x}.pairs")) for x in range(shards)]
+        shard_genes = [scratch.temp(path.join(annotate_dir, f"genes.{x}.gp")) for x in range(shards)]
+        shard_hits = [scratch.temp(path.join(annotate_dir, f"out.{x}.pairs")) for x in range(shards)]
+
+        async def split(threads: int):
+            from tools.partition import split_by_chromosome
+            await run_in_thread(split_by_chromosome, juncs, reference,
+                                [partial(x) for x in shard_juncs], [partial(x) for x in shard_genes])
+
+        scheduler.add("annotate.split", split,
+                      inputs=[juncs, reference],
+                      outputs=shard_juncs + shard_genes,
+                      params={"shards": shards})
+
+        for shard in range(shards):
+            async def chimera(threads: int, shard=shard):
+                # more shards than chromosomes leaves some of them empty
+                if not path.getsize(shard_juncs[shard]):
+                    open(partial(shard_hits[shard]), "wb").close()
+                    return 0
+                return await annotate(shard_juncs[shard], shard_genes[shard], shard_hits[shard])
+
+            scheduler.add(f"annotate.chimera.{shard}", chimera,
+                          inputs=[shard_juncs[shard], shard_genes[shard]],
+                          outputs=[shard_hits[shard]],
+                          memory=annotate_memory,
+                          params=params)
+
+        # the hits of different chromosomes never merge, the shards are put together in order
+        async def gather(threads: int):
+            from tools.partition import concat
+            await run_in_thread(concat, shard_hits, partial(out_hits))
+
+        scheduler.add("annotate.gather", gather,
+                      inputs=shard_hits,
+                      outputs=[out_hits],
+                      params={})
         return out_hits
 
 
@@ -143,41 +433,123 @@ class Assemble(Runnable):
     universal = UniversalArgs
     assemble = AssembleArgs
     align = AlignArgs
+    index = IndexArgs
     parse = ParseArgs
 
     async def run(self):
-
+        throw_if_no_binary(self.assemble.soapdenovo_binary, self.align.bwa_binary, self.parse.samtools_binary)
         self.assemble.manifest()
 
+        scheduler = self.universal.scheduler()
+        circ_fasta = self.plan(scheduler, self.assemble.assemble_dir,
+                               self.input.chimeric_reads, self.input.fastq1, self.input.fastq2)
+        await scheduler.run()
+        return circ_fasta
+
+    def plan(self, scheduler: Scheduler, assemble_dir: str, chimeric_reads: str, fastq1: str, fastq2: str):
+        '''
+        Add the assembling stages to the scheduler.
+
+        Returns the path to the sequences of the scaffolds hit by the chimeric reads.
+        '''
+        throw_if_no_binary(self.assemble.soapdenovo_binary, self.align.bwa_binary, self.parse.samtools_binary)
+        # SOAPdenovo works in the scratch, only the scaffolds are kept
+        scratch = self.universal.scratch()
+        soap_dir = scratch.temp(path.join(assemble_dir, "soap"))
+        raw_scafseq = path.join(assemble_dir, "out.scafSeq")
+
         # Construct the SOAP config and run it
-        from soap_wrapper.SOAP import SOAPdenovo
-        input = self.input
-        soap = SOAPdenovo(
-            max_read_len=input.read_length,
-            insert_size=input.insert_size,
-            reverse_seq=1 if input.reversed else 0,
-            asm_flags=input.asm_flags,
-            fastq1=input.fastq1,
-            fastq2=None if not path.isfile(input.fastq2) else input.fastq2
-        )
-        soap.generate_config(path.join(self.assemble.soap_dir, "soap.config"))
-        raw_scafseq = await soap.run(binary=self.assemble.soapdenovo_binary,
-                                     output=path.join(self.assemble.soap_dir, "out"))
+        async def soap(threads: int):
+            from soap_wrapper.SOAP import SOAPdenovo
+            soap = SOAPdenovo(
+                max_read_len=self.assemble.read_length,
+                insert_size=self.assemble.insert_size,
+                reverse_seq=1 if self.assemble.reversed else 0,
+                asm_flags=self.assemble.asm_flags,
+                fastq1=fastq1,
+                fastq2=None if not path.isfile(fastq2) else fastq2
+            )
+            makedirs(soap_dir, exist_ok=True)
+            soap.generate_config(path.join(soap_dir, "soap.config"))
+            scafseq = await soap.run(binary=self.assemble.soapdenovo_binary,
+                                     output=path.join(soap_dir, "out"),
+                                     addi=f"-p {threads}")
+            shutil.move(scafseq, partial(raw_scafseq))
+            scratch.release(soap_dir)
+
+        # Convert the chimeric reads while SOAPdenovo is running
+        chimeric_fastq = scratch.temp(self.universal.intermediate(path.join(assemble_dir, "chimeric.fq")))
+        level = self.universal.compress_intermediates
+        scheduler.add("assemble.fastq",
+                      lambda threads: async_pipeline([self.parse.samtools_binary, "fastq", chimeric_reads],
+                                                     *([self.universal.compressor(threads)] if level else []),
+                                                     stdout=partial(chimeric_fastq)),
+                      inputs=[chimeric_reads],
+                      outputs=[chimeric_fastq],
+                      threads=min(self.universal.threads, 4) if level else 1,
+                      params={"samtools": self.parse.samtools_binary,
+                              "compress_intermediates": level})
+        scheduler.add("assemble.soap", soap,
+                      inputs=[fastq1, fastq2],
+                      outputs=[raw_scafseq],
+                      threads=self.universal.threads,
+                      # the de Bruijn graph of the reads
+                      memory=lambda size: 8 * size + (1 << 30),
+                      params={"soapdenovo": self.assemble.soapdenovo_binary,
+                              "read_length": self.assemble.read_length,
+                              "insert_size": self.assemble.insert_size,
+                              "reversed": self.assemble.reversed,
+                              "asm_flags": self.assemble.asm_flags})
 
         # Align the chimeric reads to the scaffolds
-        chimeric_fastq = path.join(self.assemble.assemble_dir, "chimeric.fq")
-        await async_system(f"\"{self.parse.samtools_binary}\" fastq \"{self.input.chimeric_reads}\" > \"{chimeric_fastq}\"")
-        scafseq_hits = path.join(self.assemble.assemble_dir, "uniq.txt")
-        await async_system(f"\"{self.align.bwa_binary}\" index \"{raw_scafseq}\"")
-        await async_system(f"\"{self.align.bwa_binary}\""
-                           f" mem -t {self.universal.threads} -k {self.align.seed_length} "
-                           f"\"{raw_scafseq}\" \"{chimeric_fastq}\""
-                           f'| \"{self.parse.samtools_binary}\" view -S -q 30 -'
-                           " | awk -F\"\\t\" '{if ($3) print $3}'"
-                           f"| \"{self.assemble.uniq_binary}\" > \"{scafseq_hits}\"")
+        # the scaffolds are of this sample only, so they are indexed beside them, not in the shared store
+        scafseq_index = bwa_index_files(raw_scafseq)
+
+        async def index(threads: int):
+            building = f"{raw_scafseq}.building"
+            result = await async_pipeline([self.align.bwa_binary, "index", "-p", building, raw_scafseq])
+            for built, output in zip(bwa_index_files(building), scafseq_index):
+                if path.isfile(built):
+                    shutil.move(built, partial(output))
+            return result
+
+        scheduler.add("assemble.index", index,
+                      inputs=[raw_scafseq],
+                      outputs=scafseq_index,
+                      params={"bwa": self.align.bwa_binary})
+
+        from tools.fastq import BWA_BATCH_BASES
+        scafseq_hits = path.join(assemble_dir, "uniq.txt")
+        scheduler.add("assemble.mem",
+                      lambda threads: async_pipeline(
+                          [self.align.bwa_binary, "mem", "-K", BWA_BATCH_BASES, "-t", threads,
+                           "-k", self.align.seed_length, raw_scafseq, chimeric_fastq],
+                          [self.parse.samtools_binary, "view", "-S", "-q", 30, "-"],
+                          ["awk", "-F\t", "{if ($3) print $3}"],
+                          [sys.executable, self.assemble.uniq_binary],
+                          stdout=partial(scafseq_hits)),
+                      inputs=[raw_scafseq, chimeric_fastq] + scafseq_index,
+                      outputs=[scafseq_hits],
+                      threads=self.universal.threads,
+                      # the index of the scaffolds, and the hashes of the hits in uniq.py
+                      memory=lambda size: 2 * size + (1 << 30),
+                      params={"bwa": self.align.bwa_binary,
+                              "samtools": self.parse.samtools_binary,
+                              "seed_length": self.align.seed_length,
+                              "batch_bases": BWA_BATCH_BASES})
 
         # Write output according to the mapped sequences
-        mapped = list(map(str.rstrip, open(scafseq_hits)))
+        circ_fasta = path.join(assemble_dir, "circ.fa")
+
+        async def filter(threads: int):
+            from tools.fasta import filter_fasta
+            await run_in_thread(filter_fasta, raw_scafseq, scafseq_hits, partial(circ_fasta))
+
+        scheduler.add("assemble.filter", filter,
+                      inputs=[raw_scafseq, scafseq_hits],
+                      outputs=[circ_fasta],
+                      params={})
+        return circ_fasta
 
 
 @command("salvage")
@@ -193,8 +565,52 @@ class Quantificate(Runnable, Conditional):
     outputs the depth graph
     '''
 
+    input = QuantificateInputArgs
     universal = UniversalArgs
     quantificate = QuantificateArgs
+    parse = ParseArgs
+
+    def predicate(self) -> bool:
+        return self.input.alignments.endswith((".bam", ".sam", ".cram"))
+
+    def emit_error(self) -> MultiLine:
+        return MultiLine(Line(Component(f"Cannot quantificate on \"{self.input.alignments}\",", ColorEnum.FOREGROUND_RED)),
+                         Line(Component("the alignments should be in SAM, BAM or CRAM format.")))
 
     async def run(self):
-        pass
+        throw_if_no_binary(self.parse.samtools_binary)
+        self.universal.manifest()
+        self.quantificate.manifest()
+
+        scheduler = self.universal.scheduler()
+        out_depth, _ = self.plan(scheduler, self.quantificate.quantificate_dir, self.input.juncs, self.input.alignments)
+        await scheduler.run()
+        return out_depth
+
+    def plan(self, scheduler: Scheduler, quantificate_dir: str, juncs: str, alignments: str):
+        '''
+        Add the quantificating stage to the scheduler.
+
+        Returns the paths to the depth table and the depth graph, the graph is None without bins.
+        '''
+        throw_if_no_binary(self.parse.samtools_binary)
+        out_depth = path.join(quantificate_dir, "depth.tsv")
+        out_graph = path.join(quantificate_dir, "graph.tsv") if self.quantificate.bins else None
+        regions_bed = path.join(quantificate_dir, "regions.bed")
+
+        # the alignments are streamed through samtools, in a thread as it's mostly numpy
+        async def depth(threads: int):
+            from tools.coverage import quantificate
+            outputs = [partial(x) for x in (out_depth, out_graph, regions_bed)]
+            await run_in_thread(lambda: quantificate(juncs, alignments, *outputs,
+                                                     samtools=self.parse.samtools_binary,
+                                                     min_mapq=self.quantificate.min_mapq,
+                                                     bins=self.quantificate.bins))
+
+        scheduler.add("quantificate.depth", depth,
+                      inputs=[juncs, alignments],
+                      outputs=[out_depth, out_graph, regions_bed],
+                      params={"samtools": self.parse.samtools_binary,
+                              "min_mapq": self.quantificate.min_mapq,
+                              "bins": self.quantificate.bins})
+        return out_depth, out_graph
@@ -4,15 +4,41 @@ from wdp.cli.model import Arg, ArgGroup
 from wdp.collector.concrete.common import SimpleField
 from wdp.collector.concrete.int import Int
 from wdp.collector.concrete.str import DirLike, FileLike, Str
-from wdp.util.decorator import oneshot, singleton
+from wdp.runner.allocator import Allocator, available_cpus, available_memory
+from wdp.runner.cache import StageCache
+from wdp.runner.profiler import Profiler
+from wdp.runner.scheduler import Scheduler
+from wdp.runner.scratch import Scratch, parse_size
+from wdp.util.decorator import cached, oneshot, singleton
 import os
+import sys
 from os import name, path
-from wdp.util.error import throw_if_false
-
-
-def throw_if_no_binary(bin: str):
-    if which(bin) is None:
-        raise ArgumentTypeError(f"binary is not valid at \"{bin}\"")
+from wdp.util.error import BinaryNotFoundError, throw_if_false
+from typing import Dict, List, Tuple
+
+
+def throw_if_no_binary(*bins: str):
+    '''
+    Checked when a command starts, not on parsing, so the commands not selected never look them up.
+    '''
+    for bin in bins:
+        if which(bin) is None:
+            raise BinaryNotFoundError(f"binary is not valid at \"{bin}\"")
+
+
+def parse_weights(text: str) -> Dict[str, float]:
+    '''
+    Parse the weights of the tools like `bwa=8,samtools=1`.
+    '''
+    weights = {}
+    for item in filter(None, text.split(",")):
+        tool, _, weight = item.partition("=")
+        try:
+            weights[tool.strip()] = float(weight)
+        except ValueError:
+            raise ArgumentTypeError(f"Cannot parse {item} into TOOL=WEIGHT")
+        throw_if_false(tool and weights[tool.strip()] >= 0, ArgumentTypeError(f"Cannot parse {item} into TOOL=WEIGHT"))
+    return weights
 
 
 @singleton()
@@ -24,12 +50,27 @@ class UniversalArgs(ArgGroup):
                   meta="INT",
                   short="t",
                   long="threads",
-                  default=os.cpu_count()
+                  default=available_cpus()
                   ).field(Int().ranged(lower=0).unwrapped())
     keep_temp = Arg(default=False,
                     help="keep the temporary files",
                     long="keep-temp"
                     ).field(SimpleField(bool))
+    scratch_dir = Arg(default=os.environ.get("CATK_SCRATCH", ""),
+                      help="a fast local directory for the temporary files, like /dev/shm, leave out to use the working directory",
+                      meta="DIR",
+                      long="scratch-dir"
+                      ).field(Str().unwrapped())
+    scratch_size = Arg(default="0",
+                       help="the size budget of the scratch directory, like 16G, 0 for no limit",
+                       meta="SIZE",
+                       long="scratch-size"
+                       ).field(Str().with_validator(parse_size).unwrapped())
+    memory = Arg(default="0",
+                 help="the memory budget of the stages, like 64G, 0 for the cgroup limit or the memory available on start",
+                 meta="SIZE",
+                 long="memory"
+                 ).field(Str().with_validator(parse_size).unwrapped())
     work_dir = Arg(
         required=True,
         help="the working directory",
@@ -37,11 +78,74 @@ class UniversalArgs(ArgGroup):
         long="work-dir",
         meta="DIR"
     ).field(DirLike(exists=False))
+    no_cache = Arg(default=False,
+                   help="rerun every stage even if its inputs are unchanged",
+                   long="no-cache"
+                   ).field(SimpleField(bool))
+    hash_inputs = Arg(default=False,
+                      help="also compare the content of inputs when checking for unchanged stages",
+                      long="hash-inputs"
+                      ).field(SimpleField(bool))
+    compress_intermediates = Arg(default=0,
+                                 help="the gzip level of the intermediate reads, 0 to keep them uncompressed",
+                                 meta="INT",
+                                 long="compress-intermediates"
+                                 ).field(Int().ranged(0, 9).unwrapped())
+    thread_weights = Arg(default="bwa=8,samtools=1",
+                         help="the weights splitting the threads of a stage among the tools it runs together, the others weigh 1",
+                         meta="TOOL=FLOAT,...",
+                         long="thread-weights"
+                         ).field(Str().with_validator(parse_weights).unwrapped())
+    resume = Arg(default=False,
+                 help="restart from the first incomplete stage, the completed ones are trusted only if their outputs match the checksums",
+                 long="resume"
+                 ).field(SimpleField(bool))
+
+    xopen_binary = path.join(path.dirname(__file__), "tools", "xopen.py")
 
     @oneshot
     def manifest(self):
         self.work_dir.make()
 
+    def intermediate(self, file: str) -> str:
+        '''
+        The path of an intermediate output, gzipped if the intermediates are compressed.
+        '''
+        return f"{file}.gz" if self.compress_intermediates else file
+
+    def compressor(self, threads: int) -> List[str]:
+        '''
+        The command compressing stdin to stdout into BGZF by the level of intermediates.
+        '''
+        return [sys.executable, self.xopen_binary, "-l", self.compress_intermediates, "-@", threads]
+
+    @cached
+    def cache(self) -> StageCache:
+        return StageCache(path.join(self.work_dir.inner, "manifest.json"),
+                          content=self.hash_inputs,
+                          enabled=not self.no_cache,
+                          resume=self.resume)
+
+    @cached
+    def allocator(self) -> Allocator:
+        return Allocator(parse_weights(self.thread_weights))
+
+    @cached
+    def profiler(self) -> Profiler:
+        return Profiler(path.join(self.work_dir.inner, "report.json"))
+
+    @cached
+    def scratch(self) -> Scratch:
+        return Scratch(self.work_dir.inner, self.scratch_dir or None, parse_size(self.scratch_size), self.keep_temp)
+
+    @cached
+    def memory_budget(self) -> int:
+        return parse_size(self.memory) or available_memory()
+
+    def scheduler(self) -> Scheduler:
+        return Scheduler(self.threads, cache=self.cache(), profiler=self.profiler(), scratch=self.scratch(),
+                         memory=self.memory_budget())
+
 
 @singleton()
 class AlignArgs(ArgGroup):
@@ -58,9 +162,15 @@ class AlignArgs(ArgGroup):
                      meta="STR",
                      long="bwa-binary",
                      default="bwa"
-                     ).field(Str()
-                             .with_validator(throw_if_no_binary)
-                             .unwrapped())
+                     ).field(Str().unwrapped())
+
+    shards = Arg(required=False,
+                 help="split the reads into shards aligned in parallel, 0 for one per 16 threads",
+                 meta="INT",
+                 long="shards",
+                 default=0).field(Int().ranged(lower=0).unwrapped())
+
+    fastq_binary = path.join(path.dirname(__file__), 'tools', "fastq.py")
 
     # Stole from UniversalArgs
     work_dir = DirLike(exists=False)
@@ -74,6 +184,35 @@ class AlignArgs(ArgGroup):
         self.align_dir = self.align_dir.unwrap()
 
 
+@singleton()
+class IndexArgs(ArgGroup):
+    name = "index store arguments"
+
+    index_dir = Arg(required=False,
+                    help="the directory of the bwa indexes shared across runs",
+                    meta="DIR",
+                    long="index-dir",
+                    default=os.environ.get("CATK_INDEX_DIR",
+                                           path.join(path.expanduser("~"), ".cache", "catk", "index"))
+                    ).field(DirLike(exists=False).unwrapped())
+
+    @cached
+    def store(self):
+        from tools.index import IndexStore
+        return IndexStore(self.index_dir)
+
+
+@singleton()
+class IndexInputArgs(ArgGroup):
+    name = "index input file arguments"
+
+    reference = Arg(required=True,
+                    help="the reference fasta to build the index from",
+                    meta="FILE",
+                    long="reference",
+                    short="r").field(FileLike(exists=True).unwrapped())
+
+
 @singleton()
 class AlignInputArgs(ArgGroup):
     name = "aligning input file arguments"
@@ -110,17 +249,12 @@ class ParseArgs(ArgGroup):
     name = "parsing arguments"
 
     chimera_binary = path.join(path.dirname(__file__), 'tools', "chimera-bin")
-    uniq_binary = path.join(path.dirname(__file__), 'tools', "uniq.py")
 
     samtools_binary = Arg(required=False,
                           help="the samtools binary path",
                           meta="STR",
                           long="samtools-binary",
-                          default="samtools").field(
-                              Str()
-        .with_validator(throw_if_no_binary)
-        .unwrapped()
-    )
+                          default="samtools").field(Str().unwrapped())
 
     extend_length = Arg(default=0,
                         help="the extended region for the pairs",
@@ -138,6 +272,17 @@ class ParseArgs(ArgGroup):
                             .unwrapped()
     )
 
+    merge_backend = Arg(default="auto",
+                        help="how the regions are merged, by chimera-bin or in process by numpy, auto to use chimera-bin if it's built",
+                        choices=["auto", "chimera", "numpy"],
+                        meta="STR",
+                        long="merge-backend").field(Str().unwrapped())
+
+    def merge_by_chimera(self) -> bool:
+        if self.merge_backend == "auto":
+            return which(self.chimera_binary) is not None
+        return self.merge_backend == "chimera"
+
     # Stole from UniversalArgs
     work_dir = DirLike(exists=False)
     keep_temp: bool = SimpleField(bool)
@@ -156,28 +301,43 @@ class AssembleArgs(ArgGroup):
     soapdenovo_binary = Arg(default="SOAPdenovo-Trans-31mer",
                             help="the SOAPdenovo-Trans binary path",
                             long="soapdenovo-binary",
-                            meta="STR").field(Str().with_validator(throw_if_no_binary).unwrapped())
+                            meta="STR").field(Str().unwrapped())
     uniq_binary = Arg(default=path.join(path.dirname(__file__), "tools", "uniq.py"),
                       help="the uniq.py binary path",
                       long="uniq-binary",
                       meta="STR").field(FileLike(exists=True).unwrapped())
 
+    read_length = Arg(default=150,
+                      help="the max read length of the chimeric reads, excessive ones will be truncated",
+                      meta="INT",
+                      long="read-length").field(Int().ranged(0,).unwrapped())
+
+    insert_size = Arg(default=150,
+                      help="the insert size of the reads",
+                      meta="INT",
+                      long="insert-size").field(Int().ranged(0,).unwrapped())
+
+    reversed: bool = Arg(default=False,
+                         help="if the reads should be reversed, set the reverse_seq flag to 1",
+                         long="reversed").field(SimpleField(bool))
+
+    asm_flags = Arg(default=3,
+                    help="the asm_flags in SOAPdenovo config",
+                    meta="INT",
+                    long="asm-flags").field(Int().unwrapped())
+
     # Stole from UniversalArgs
     work_dir = DirLike(exists=False)
     keep_temp: bool = SimpleField(bool)
 
     # Generated
     assemble_dir: str
-    soap_dir: str
 
     @oneshot
     def manifest(self):
         self.assemble_dir = DirLike(exists=False).accept(path.join(self.work_dir.unwrap(), "assemble"))
         self.assemble_dir.make()
         self.assemble_dir = self.assemble_dir.unwrap()
-        self.soap_dir = DirLike(exists=False).accept(path.join(self.assemble_dir, "soap"))
-        self.soap_dir.make()
-        self.soap_dir = self.soap_dir.unwrap()
 
 
 @singleton()
@@ -190,25 +350,6 @@ class AssembleInputArgs(ArgGroup):
                          long="chimeric-reads",
                          short="c").field(FileLike(exists=True).unwrapped())
 
-    read_length = Arg(default=150,
-                      help="the max read length of the chimeric reads, excessive ones will be truncated",
-                      meta="INT",
-                      long="read-length").field(Int().ranged(0,).unwrapped())
-
-    insert_size = Arg(default=150,
-                      help="the insert size of the reads",
-                      meta="INT",
-                      long="insert-size").field(Int().ranged(0,).unwrapped())
-
-    reversed: bool = Arg(default=False,
-                         help="if the reads should be reversed, set the reverse_seq flag to 1",
-                         long="reversed").field(SimpleField(bool))
-
-    asm_flags = Arg(default=3,
-                    help="the asm_flags in SOAPdenovo config",
-                    meta="INT",
-                    long="asm-flags").field(Int().unwrapped())
-
     fastq1 = Arg(required=True,
                  help="reads set 1 in fastq format",
                  meta="FILE",
@@ -243,6 +384,11 @@ class AnnotateArgs(ArgGroup):
                         meta="INT",
                         long="extend-length").field(Int().ranged(0,).unwrapped())
 
+    shards = Arg(default=0,
+                 help="split the junctions by chromosome into shards annotated in parallel, 0 for one per thread up to 16",
+                 meta="INT",
+                 long="shards").field(Int().ranged(0,).unwrapped())
+
 
 @singleton()
 class AnnotateInputArgs(ArgGroup):
@@ -274,6 +420,103 @@ class AnnotateInputArgs(ArgGroup):
 class QuantificateArgs(ArgGroup):
     name = "quantificate arguments"
 
+    bins = Arg(default=0,
+               help="the bins of the depth graph of each circRNA, 0 to skip the graph",
+               meta="INT",
+               long="bins").field(Int().ranged(0,).unwrapped())
+
+    min_mapq = Arg(default=30,
+                   help="the minimum mapping quality of the alignments counted in depth",
+                   meta="INT",
+                   long="min-mapq").field(Int().ranged(0,).unwrapped())
+
     # Stole from UniversalArgs
     work_dir = DirLike(exists=False)
     keep_temp: bool = SimpleField(bool)
+    quantificate_dir: str
+
+    @oneshot
+    def manifest(self):
+        self.quantificate_dir = DirLike(exists=False).accept(path.join(self.work_dir.inner, "quantificate"))
+        self.quantificate_dir.make()
+        self.quantificate_dir = self.quantificate_dir.unwrap()
+
+
+@singleton()
+class QuantificateInputArgs(ArgGroup):
+    name = "quantificate input file arguments"
+
+    juncs = Arg(required=True,
+                help="the junction file input, the uniq pairs of align or the hits of annotate",
+                meta="FILE",
+                long="juncs",
+                short="j").field(FileLike(exists=True).unwrapped())
+
+    alignments = Arg(required=True,
+                     help="the alignments of the reads, the mapped.bam of align",
+                     meta="FILE",
+                     long="alignments",
+                     short="a").field(FileLike(exists=True).unwrapped())
+
+
+@singleton()
+class BatchInputArgs(ArgGroup):
+    name = "batch input file arguments"
+
+    samples = Arg(required=True,
+                  help="the sample sheet, a TSV of sample id, fq1 and optionally fq2",
+                  meta="FILE",
+                  long="samples",
+                  short="s").field(FileLike(exists=True).unwrapped())
+
+    db = Arg(required=True,
+             help="the path to the query fasta, or the prefix to the bwa index",
+             meta="FILE",
+             long="db",
+             short="d").field(FileLike(exists=False).unwrapped())
+
+    prefix: bool = Arg(
+        help="if the db is the prefix to the bwa index",
+        long="prefix",
+        short="p",
+        default=False).field(SimpleField(bool))
+
+    reference = Arg(default="",
+                    help="the reference file in GenePred format, annotate the samples if specified",
+                    meta="FILE",
+                    long="reference",
+                    short="r").field(FileLike(exists=False).unwrapped())
+
+    annotate_extend = Arg(default=10,
+                          help="the extended region for the annotated hits",
+                          meta="INT",
+                          long="annotate-extend").field(Int().ranged(0,).unwrapped())
+
+    skip_assemble: bool = Arg(default=False,
+                              help="do not assemble the samples",
+                              long="skip-assemble").field(SimpleField(bool))
+
+    max_samples = Arg(default=0,
+                      help="the samples processed at the same time, 0 to use a sample per 8 threads",
+                      meta="INT",
+                      long="max-samples").field(Int().ranged(0,).unwrapped())
+
+    def sheet(self) -> List[Tuple[str, str, str]]:
+        '''
+        Read the sample sheet, lines started with # are ignored.
+        '''
+        samples = []
+        for line in map(str.rstrip, open(self.samples)):
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            throw_if_false(len(fields) in (2, 3),
+                           ValueError(f"Cannot parse \"{line}\" into sample, fq1[, fq2]"))
+            sample, fq1, fq2 = (fields + [""])[:3]
+            for fq in (fq1, fq2):
+                throw_if_false(not fq or path.isfile(fq), ValueError(f"\"{fq}\" is not a valid file."))
+            samples.append((sample, fq1, fq2))
+
+        names = [x[0] for x in samples]
+        throw_if_false(len(set(names)) == len(names), ValueError("The sample ids are not unique."))
+        return samples
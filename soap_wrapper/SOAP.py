@@ -1,5 +1,6 @@
 from dataclasses import dataclass
-from utils import async_system
+import shlex
+from utils import async_pipeline
 from os import path
 
 CONFIG_BASE = path.join(path.dirname(__file__), "config_template")
@@ -29,5 +30,5 @@ class SOAPdenovo():
             except:
                 raise AttributeError("SOAPdenovo wrapper is not initialized")
 
-        await async_system(f"\"{binary}\" all -s \"{config_path}\" -o \"{output}\" {addi}")
+        await async_pipeline([binary, "all", "-s", config_path, "-o", output] + shlex.split(addi))
         return f"{output}.scafSeq"
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wdp.runner.cache import StageCache, partial
+from wdp.runner.profiler import run_in_thread
+from wdp.runner.scheduler import Scheduler
+from wdp.runner.scratch import Scratch
+
+
+def pipe_pair(work_dir: str, runs: list) -> Scheduler:
+    '''
+    A stage copying the source into a pipe, and one reading the pipe into the output in upper case.
+    '''
+    source, output = os.path.join(work_dir, "source.txt"), os.path.join(work_dir, "output.txt")
+    scratch = Scratch(work_dir)
+    pipe = scratch.pipe(os.path.join(work_dir, "pipe.txt"))
+    scheduler = Scheduler(2, cache=StageCache(os.path.join(work_dir, "manifest.json")), scratch=scratch)
+
+    def copy(reader: str, writer: str, transform):
+        with open(reader) as r, open(writer, "w") as w:
+            w.write(transform(r.read()))
+
+    async def write(threads: int):
+        runs.append("write")
+        await run_in_thread(copy, source, partial(pipe), str)
+
+    async def read(threads: int):
+        runs.append("read")
+        await run_in_thread(copy, pipe, partial(output), str.upper)
+
+    scheduler.add("write", write, inputs=[source], outputs=[pipe], params={})
+    scheduler.add("read", read, inputs=[pipe], outputs=[output], params={})
+    return scheduler
+
+
+def run(work_dir: str) -> list:
+    runs = []
+    asyncio.run(asyncio.wait_for(pipe_pair(work_dir, runs).run(), 10))
+    return sorted(runs)
+
+
+def test_pipe_reader_reruns_with_its_writer(tmp_path):
+    source, output = tmp_path / "source.txt", tmp_path / "output.txt"
+    source.write_text("one\n")
+    assert run(str(tmp_path)) == ["read", "write"]
+    assert output.read_text() == "ONE\n"
+
+    assert run(str(tmp_path)) == []
+
+    source.write_text("two words\n")
+    assert run(str(tmp_path)) == ["read", "write"]
+    assert output.read_text() == "TWO WORDS\n"
+    assert run(str(tmp_path)) == []
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from tools.pairs import Chromosomes, format_columns
+from tools.tsv import read_batches
+from tools.xopen import xopen
+
+MAGIC = b"CATKCOL1"
+# the magic and the length of the JSON header before the header
+PREAMBLE = struct.Struct("<8sQ")
+SUFFIX = ".col"
+
+# the names of the columns of the known tab separated files, by their widths
+KNOWN_COLUMNS = {3: ["chr", "start", "end"],
+                 4: ["chr", "start", "end", "read"],
+                 8: ["chr", "start", "end", "type", "strand", "starts", "ends", "depth"]}
+
+
+def aligned(offset: int) -> int:
+    return -(-offset // 8) * 8
+
+
+def is_table(file: str) -> bool:
+    # only regular files, as peeking a FIFO would take the bytes from its reader
+    if not os.path.isfile(file):
+        return False
+    with open(file, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class TableWriter():
+    '''
+    Write a table of columns in batches of rows, into the binary columnar format.
+
+    A column is either integers, stored as uint32 or uint64 by the largest value, or int64 if any is negative,
+    or bytes, stored as the offsets of the values in a heap of them, uint32 unless the heap is over 4GB. The `chr` column is bytes
+    encoded by a dictionary of the chromosomes into uint32.
+
+    The batches are spilled into temporary files beside the output, and laid out as columns on close.
+    '''
+
+    def __init__(self, file: str, names: List[str]) -> None:
+        self.file = file
+        self.names = list(names)
+        self.temp = tempfile.TemporaryDirectory(prefix=".columns.", dir=os.path.dirname(os.path.abspath(file)))
+        self.spills = {x: open(os.path.join(self.temp.name, x), "wb") for x in self.names}
+        self.heaps = {x: open(os.path.join(self.temp.name, f"{x}.heap"), "wb") for x in self.names}
+        self.types: Dict[str, str] = {}
+        self.bounds = {x: (0, 0) for x in self.names}
+        self.chromosomes = Chromosomes()
+        self.rows = 0
+
+    def write(self, columns: Dict[str, np.ndarray]):
+        rows = {len(columns[x]) for x in self.names}
+        if len(rows) != 1:
+            raise ValueError(f"The columns of a batch should have the same number of rows, not {sorted(rows)}.")
+        if not rows.pop():
+            return
+        for name in self.names:
+            column = np.asarray(columns[name])
+            kind = "chr" if name == "chr" else "bytes" if column.dtype.kind in "SO" else "int"
+            if self.types.setdefault(name, kind) != kind:
+                raise ValueError(f"The column {name} should be {self.types[name]}, not {kind}.")
+            if kind == "chr":
+                self.chromosomes.encode(column.astype(bytes)).astype(np.uint32).tofile(self.spills[name])
+            elif kind == "bytes":
+                values = column.astype(bytes)
+                np.char.str_len(values).astype(np.uint64).tofile(self.spills[name])
+                self.heaps[name].write(b"".join(values.tolist()))
+            else:
+                values = column.astype(np.int64)
+                if len(values):
+                    low, high = self.bounds[name]
+                    self.bounds[name] = (min(low, int(values.min())), max(high, int(values.max())))
+                values.tofile(self.spills[name])
+        self.rows += len(columns[self.names[0]])
+
+    def dtype(self, name: str) -> np.dtype:
+        if self.types.get(name, "int") == "chr":
+            return np.dtype(np.uint32)
+        if self.types.get(name, "int") == "bytes":
+            return np.dtype(np.uint32 if self.heaps[name].tell() < 1 << 32 else np.uint64)
+        low, high = self.bounds[name]
+        return np.dtype(np.int64 if low < 0 else np.uint32 if high < 1 << 32 else np.uint64)
+
+    def close(self):
+        dtypes = {x: self.dtype(x) for x in self.names}
+        for f in list(self.spills.values()) + list(self.heaps.values()):
+            f.close()
+        columns, offset = [], 0
+        for name in self.names:
+            dtype = dtypes[name]
+            column = {"name": name, "type": self.types.get(name, "int"), "dtype": dtype.str, "offset": offset}
+            # the bytes are the offsets into the heap, one more than the rows
+            offset = aligned(offset + dtype.itemsize * (self.rows + (column["type"] == "bytes")))
+            if column["type"] == "bytes":
+                column["heap"] = offset
+                column["heap_size"] = os.path.getsize(os.path.join(self.temp.name, f"{name}.heap"))
+                offset = aligned(offset + column["heap_size"])
+            columns.append(column)
+        header = json.dumps({"rows": self.rows,
+                             "chromosomes": [x.decode("latin-1") for x in self.chromosomes.names],
+                             "columns": columns}).encode()
+
+        partial = f"{self.file}.{os.getpid()}"
+        with open(partial, "wb") as out:
+            out.write(PREAMBLE.pack(MAGIC, len(header)) + header)
+            start = aligned(PREAMBLE.size + len(header))
+            for column in columns:
+                name = column["name"]
+                out.write(b"\0" * (start + column["offset"] - out.tell()))
+                spill = np.memmap(os.path.join(self.temp.name, name), mode="r",
+                                  dtype=np.uint64 if column["type"] == "bytes" else np.int64
+                                  if column["type"] == "int" else np.uint32) if self.rows else np.empty(0, np.int64)
+                if column["type"] == "bytes":
+                    out.write(np.zeros(1, dtype=column["dtype"]).tobytes())
+                    total = 0
+                    for i in range(0, self.rows, 1 << 22):
+                        ends = np.cumsum(spill[i:i + (1 << 22)], dtype=np.uint64) + np.uint64(total)
+                        out.write(ends.astype(column["dtype"]).tobytes())
+                        total = int(ends[-1])
+                    out.write(b"\0" * (start + column["heap"] - out.tell()))
+                    with open(os.path.join(self.temp.name, f"{name}.heap"), "rb") as heap:
+                        while chunk := heap.read(1 << 20):
+                            out.write(chunk)
+                else:
+                    for i in range(0, self.rows, 1 << 22):
+                        out.write(spill[i:i + (1 << 22)].astype(column["dtype"]).tobytes())
+                del spill
+        os.replace(partial, self.file)
+        self.temp.cleanup()
+
+    def __enter__(self) -> "TableWriter":
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        else:
+            for f in list(self.spills.values()) + list(self.heaps.values()):
+                f.close()
+            self.temp.cleanup()
+
+
+class Table():
+    '''
+    A table in the binary columnar format, memory mapped, so the columns are read only where they are used.
+    '''
+
+    def __init__(self, file: str) -> None:
+        self.file = file
+        with open(file, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = PREAMBLE.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{file} is not a columnar table.")
+        header = json.loads(self.map[PREAMBLE.size:PREAMBLE.size + length])
+        self.start = aligned(PREAMBLE.size + length)
+        self.rows: int = header["rows"]
+        self.chromosomes = np.array([x.encode("latin-1") for x in header["chromosomes"]], dtype=bytes)
+        self.columns = {x["name"]: x for x in header["columns"]}
+        self.names = [x["name"] for x in header["columns"]]
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def raw(self, name: str) -> np.ndarray:
+        '''
+        The stored array of the column, the chromosome ids of `chr`, or the heap offsets of the bytes.
+        '''
+        column = self.columns[name]
+        count = self.rows + (column["type"] == "bytes")
+        return np.frombuffer(self.map, dtype=column["dtype"], count=count, offset=self.start + column["offset"])
+
+    def column(self, name: str, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        '''
+        The values of the rows of the column, the bytes are a fixed width bytes array.
+        '''
+        column = self.columns[name]
+        stop = self.rows if stop is None else min(stop, self.rows)
+        if column["type"] == "int":
+            return self.raw(name)[start:stop]
+        if column["type"] == "chr":
+            return self.chromosomes[self.raw(name)[start:stop]] if len(self.chromosomes) else np.empty(0, dtype="S1")
+        offsets = self.raw(name)[start:stop + 1].astype(np.int64)
+        lengths = np.diff(offsets)
+        width = max(int(lengths.max()) if len(lengths) else 0, 1)
+        heap = np.frombuffer(self.map, dtype=np.uint8, count=column["heap_size"], offset=self.start + column["heap"])
+        # gather the bytes of each value into a row, padded by nulls
+        positions = np.arange(width)
+        index = np.minimum(offsets[:-1, None] + positions, max(len(heap) - 1, 0))
+        chars = np.where(positions < lengths[:, None], heap[index] if len(heap) else 0, 0).astype(np.uint8)
+        return np.ascontiguousarray(chars).view(f"S{width}").reshape(-1)
+
+    def batches(self, rows: int = 1 << 22) -> Iterator[Dict[str, np.ndarray]]:
+        for start in range(0, self.rows, rows):
+            yield {x: self.column(x, start, start + rows) for x in self.names}
+
+
+def is_integers(column: np.ndarray) -> bool:
+    digits = np.char.lstrip(column, b"-")
+    return bool(len(column)) and bool(np.all(np.char.isdigit(digits)))
+
+
+def tsv_to_table(source: str, output: str, names: Optional[List[str]] = None):
+    '''
+    Convert a tab separated file into a table, the integer columns are found by the first batch of lines.
+
+    Without the names, the known files are named by their widths, the others `chr` then `c1`, `c2`...
+    '''
+    writer, kinds = None, None
+    for batch in read_batches(source):
+        if writer is None:
+            width = batch.width
+            kinds = [is_integers(batch.field(x)) for x in range(width)]
+            if names is None:
+                names = KNOWN_COLUMNS.get(width, ["chr"] + [f"c{x}" for x in range(1, width)])
+                if width == 4 and kinds[3]:
+                    names = names[:3] + ["count"]
+            if len(names) != width:
+                raise ValueError(f"{len(names)} names for {width} columns.")
+            writer = TableWriter(output, names)
+        writer.write({name: batch.ints(i) if kind and name != "chr" else batch.field(i)
+                      for i, (name, kind) in enumerate(zip(names, kinds))})
+    if writer is None:
+        writer = TableWriter(output, names or KNOWN_COLUMNS[3])
+    writer.close()
+
+
+def table_to_tsv(source: str, output: str):
+    table = Table(source)
+    with xopen(output, "wb") as f:
+        for batch in table.batches():
+            f.write(format_columns(*(batch[x] for x in table.names)))
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="convert the tab separated pairs and hits from and to the binary columnar format")
+    parser.add_argument("file", help="the tab separated file, gzipped or not, or the columnar table")
+    parser.add_argument("-o", "--output", required=True, help=f"the output path, a table if ends with {SUFFIX}")
+    parser.add_argument("-n", "--names", default=None, help="the names of the columns, separated by commas")
+    args = parser.parse_args()
+
+    if args.output.endswith(SUFFIX):
+        tsv_to_table(args.file, args.output, args.names.split(",") if args.names else None)
+    else:
+        table_to_tsv(args.file, args.output)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import re
+import subprocess
+from array import array
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from tools.xopen import xopen
+
+CIGAR = re.compile(rb"(\d+)([MIDNSHP=X])")
+
+
+class Circles():
+    '''
+    The circRNAs to quantificate, keyed by their junctions.
+
+    Positions are packed with the contig id as `contig << 32 | pos`, so they sort by contig first.
+    '''
+
+    def __init__(self, juncs: str) -> None:
+        self.contigs: List[bytes] = []
+        self.ids: Dict[bytes, int] = {}
+        reads: Dict[Tuple[int, int, int], int] = {}
+        with xopen(juncs) as f:
+            for line in f:
+                fields = line.rstrip(b"\n").split(b"\t")
+                if len(fields) < 4:
+                    continue
+                if fields[0] not in self.ids:
+                    self.ids[fields[0]] = len(self.contigs)
+                    self.contigs.append(fields[0])
+                # the single hits of annotate negate the sites out of any exon
+                key = (self.ids[fields[0]], abs(int(fields[1])), abs(int(fields[2])))
+                if key[1] < key[2]:
+                    reads[key] = reads.get(key, 0) + int(fields[-1])
+
+        keys = np.array(list(reads), dtype=np.int64).reshape(-1, 3)
+        self.chrs = keys[:, 0]
+        self.starts = keys[:, 1]
+        self.ends = keys[:, 2]
+        self.reads = np.array(list(reads.values()), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.reads)
+
+
+class Regions():
+    '''
+    The disjoint union of the circRNA regions, laid side by side in a compact coordinate,
+    so the coverage buffer only spans the bases covered by some circRNA.
+    '''
+
+    def __init__(self, circles: Circles) -> None:
+        starts = circles.chrs << 32 | circles.starts
+        ends = circles.chrs << 32 | circles.ends
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+        # a region starts where no previous circRNA reaches
+        reach = np.maximum.accumulate(ends)
+        first = np.flatnonzero(np.append(True, starts[1:] > reach[:-1])) if len(starts) else np.empty(0, dtype=np.int64)
+        self.starts = starts[first]
+        self.ends = np.maximum.reduceat(ends, first) if len(first) else ends
+        self.lengths = self.ends - self.starts
+        self.offsets = np.append(0, np.cumsum(self.lengths))[:-1]
+        self.size = int(self.lengths.sum())
+
+    def compact(self, positions: np.ndarray) -> np.ndarray:
+        '''
+        Map the packed positions into the compact coordinate, the gaps between regions collapse to a point.
+        '''
+        i = np.searchsorted(self.starts, positions, side="right") - 1
+        inside = np.maximum(i, 0)
+        mapped = self.offsets[inside] + np.minimum(positions - self.starts[inside], self.lengths[inside])
+        return np.where(i < 0, 0, mapped)
+
+    def write_bed(self, contigs: List[bytes], bed: str):
+        with open(bed, "wb") as f:
+            for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+                # the positions are 1-based, bed is 0-based
+                f.write(b"%s\t%d\t%d\n" % (contigs[start >> 32], (start & 0xffffffff) - 1, (end & 0xffffffff) - 1))
+
+
+@lru_cache(maxsize=1 << 16)
+def cigar_blocks(cigar: bytes) -> Tuple[Tuple[int, int], ...]:
+    '''
+    The aligned blocks of a CIGAR as offsets to the leftmost position, the same CIGARs repeat a lot.
+    '''
+    blocks, offset = [], 0
+    for length, op in CIGAR.findall(cigar):
+        length = int(length)
+        if op in b"M=X":
+            blocks.append((offset, offset + length))
+        if op in b"MDN=X":
+            offset += length
+    return tuple(blocks)
+
+
+class Coverage():
+    '''
+    The depth over the regions, accumulated as a difference array in int32.
+
+    The aligned blocks are buffered and added in batches, so memory is bounded
+    by the regions and the batch size, not by the number of reads.
+    '''
+
+    def __init__(self, regions: Regions, batch: int = 1 << 20) -> None:
+        self.regions = regions
+        self.batch = batch
+        self.diff = np.zeros(regions.size + 1, dtype=np.int32)
+        self.starts, self.ends = array("q"), array("q")
+        self.reads = 0
+
+    def add_sam(self, lines: Iterable[bytes], ids: Dict[bytes, int]):
+        starts, ends = self.starts, self.ends
+        for line in lines:
+            _, _, rname, pos, _, cigar, _ = line.split(b"\t", 6)
+            contig = ids.get(rname)
+            if contig is None or cigar == b"*":
+                continue
+            base = contig << 32 | int(pos)
+            for start, end in cigar_blocks(cigar):
+                starts.append(base + start)
+                ends.append(base + end)
+            self.reads += 1
+            if len(starts) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        if not len(self.starts):
+            return
+        starts = self.regions.compact(np.frombuffer(self.starts, dtype=np.int64))
+        ends = self.regions.compact(np.frombuffer(self.ends, dtype=np.int64))
+        covered = starts < ends
+        np.add.at(self.diff, starts[covered], 1)
+        np.add.at(self.diff, ends[covered], -1)
+        del self.starts[:], self.ends[:]
+
+    def depth(self) -> np.ndarray:
+        self.flush()
+        return np.cumsum(self.diff[:-1], dtype=np.int32)
+
+
+def stream_alignments(samtools: str, alignments: str, bed: str, min_mapq: int) -> Iterable[bytes]:
+    '''
+    Stream the primary mapped alignments overlapping the regions, without headers.
+    '''
+    command = [samtools, "view", "-F", "0x904", "-q", str(min_mapq), "-L", bed, alignments]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1 << 20)
+    yield from process.stdout
+    process.stdout.close()
+    if process.wait():
+        raise RuntimeError(f"{' '.join(command)} failed with exit code {process.returncode}")
+
+
+def quantificate(juncs: str, alignments: str, out_depth: str, out_graph: str = None, bed: str = None,
+                 samtools: str = "samtools", min_mapq: int = 30, bins: int = 0) -> int:
+    '''
+    Write the back-splice reads, the mean depth and the covered fraction of each circRNA,
+    and its depth in `bins` equal bins if `out_graph` is given.
+
+    Returns the number of alignments counted.
+    '''
+    circles = Circles(juncs)
+    regions = Regions(circles)
+    bed = bed or f"{out_depth}.bed"
+    regions.write_bed(circles.contigs, bed)
+
+    coverage = Coverage(regions)
+    if len(circles):
+        coverage.add_sam(stream_alignments(samtools, alignments, bed, min_mapq), circles.ids)
+    depth = coverage.depth()
+
+    # prefix sums, so any span is summed in constant time
+    summed = np.append(0, np.cumsum(depth, dtype=np.int64))
+    covered = np.append(0, np.cumsum(depth > 0, dtype=np.int64))
+    starts = regions.compact(circles.chrs << 32 | circles.starts)
+    ends = regions.compact(circles.chrs << 32 | circles.ends)
+    lengths = ends - starts
+
+    with xopen(out_depth, "wb") as f:
+        means = (summed[ends] - summed[starts]) / lengths
+        fractions = (covered[ends] - covered[starts]) / lengths
+        for i in range(len(circles)):
+            f.write(b"%s\t%d\t%d\t%d\t%.2f\t%.3f\n" % (circles.contigs[circles.chrs[i]], circles.starts[i], circles.ends[i],
+                                                      circles.reads[i], means[i], fractions[i]))
+
+    if out_graph and bins > 0:
+        edges = starts[:, None] + lengths[:, None] * np.arange(bins + 1) // bins
+        graph = (summed[edges[:, 1:]] - summed[edges[:, :-1]]) / np.maximum(np.diff(edges, axis=1), 1)
+        with xopen(out_graph, "wb") as f:
+            for i in range(len(circles)):
+                f.write(b"%s\t%d\t%d\t%s\n" % (circles.contigs[circles.chrs[i]], circles.starts[i], circles.ends[i],
+                                               ",".join(f"{x:.2f}" for x in graph[i]).encode()))
+    return coverage.reads
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="compute the depth of each circRNA from the alignments")
+    parser.add_argument("juncs", help="the junctions, the uniq pairs of align or the hits of annotate")
+    parser.add_argument("alignments", help="the alignments in SAM, BAM or CRAM format")
+    parser.add_argument("-o", "--output", required=True, help="the depth table")
+    parser.add_argument("--graph", default=None, help="the depth graph, written only with --bins")
+    parser.add_argument("--bins", type=int, default=0, help="the bins of the depth graph of each circRNA")
+    parser.add_argument("--min-mapq", type=int, default=30, help="the minimum mapping quality of the alignments")
+    parser.add_argument("--samtools", default="samtools", help="the samtools binary path")
+    args = parser.parse_args()
+    quantificate(args.juncs, args.alignments, args.output, args.graph,
+                 samtools=args.samtools, min_mapq=args.min_mapq, bins=args.bins)
@@ -0,0 +1,105 @@
+import mmap
+import os
+from typing import BinaryIO, Dict, Iterable, NamedTuple
+
+from tools.xopen import xopen
+
+
+class FaiRecord(NamedTuple):
+    length: int
+    offset: int
+    line_bases: int
+    line_width: int
+
+
+class FastaIndex():
+    '''
+    The faidx compatible index of a fasta, cached in `<fasta>.fai`
+    and built again only if the fasta is newer than it.
+    '''
+
+    def __init__(self, fasta: str) -> None:
+        self.fasta = fasta
+        self.fai = f"{fasta}.fai"
+        if not os.path.isfile(self.fai) or os.stat(self.fai).st_mtime_ns < os.stat(fasta).st_mtime_ns:
+            self.build()
+        self.records: Dict[bytes, FaiRecord] = {}
+        with open(self.fai, "rb") as f:
+            for line in f:
+                name, *fields = line.rstrip(b"\n").split(b"\t")
+                self.records[name] = FaiRecord(*map(int, fields[:4]))
+
+    def build(self):
+        '''
+        Scan the fasta once, each record must have lines of the same width except its last one.
+        '''
+        temp = f"{self.fai}.{os.getpid()}"
+        with open(self.fasta, "rb") as f, open(temp, "wb") as out:
+            name, record, offset, last = None, None, 0, False
+
+            def flush():
+                if name is not None:
+                    out.write(b"%s\t%d\t%d\t%d\t%d\n" % (name, *record))
+
+            for line in f:
+                if line.startswith(b">"):
+                    flush()
+                    name = line[1:].split(None, 1)[0] if line[1:].strip() else b""
+                    record, last = [0, offset + len(line), 0, 0], False
+                elif name is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    if last and bases:
+                        raise ValueError(f"Different line length in sequence \"{name.decode()}\" of {self.fasta}.")
+                    if not record[2]:
+                        record[2], record[3] = bases, len(line)
+                    elif bases != record[2]:
+                        last = True
+                    record[0] += bases
+                offset += len(line)
+            flush()
+        os.replace(temp, self.fai)
+
+    def __contains__(self, name: bytes) -> bool:
+        return name in self.records
+
+    def span(self, name: bytes, size: int) -> slice:
+        '''
+        The bytes of the sequence lines of the record, excluding its header.
+        '''
+        record = self.records[name]
+        if not record.line_bases:
+            return slice(record.offset, record.offset)
+        lines, rest = divmod(record.length, record.line_bases)
+        end = record.offset + lines * record.line_width + (rest + record.line_width - record.line_bases if rest else 0)
+        return slice(record.offset, min(end, size))
+
+    def extract(self, names: Iterable[bytes], output: BinaryIO) -> int:
+        '''
+        Copy the records of the names, headers included, from the fasta in the order they are stored.
+
+        The fasta is memory mapped, so only the copied records are read.
+        Returns the number of records written.
+        '''
+        wanted = sorted({x for x in names if x in self.records}, key=lambda x: self.records[x].offset)
+        if not wanted:
+            return 0
+        with open(self.fasta, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for name in wanted:
+                span = self.span(name, len(mm))
+                # the header is the line right before the sequence
+                header = mm.rfind(b"\n", 0, span.start - 1) + 1
+                output.write(mm[header:span.stop])
+                if span.stop == len(mm) and mm[span.stop - 1:span.stop] != b"\n":
+                    output.write(b"\n")
+        return len(wanted)
+
+
+def filter_fasta(fasta: str, hits: str, output: str) -> int:
+    '''
+    Write the records of the fasta named by the first column of `hits`,
+    the hits can be gzipped, and the output is if it ends with `.gz`.
+    '''
+    with xopen(hits) as f:
+        names = [x.split(b"\t", 1)[0].strip() for x in f]
+    with xopen(output, "wb") as f:
+        return FastaIndex(fasta).extract(names, f)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, List, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.xopen import GZIP_MAGIC
+
+CHUNK = 1 << 20
+# the bases `bwa mem -K` reads in a batch, fixed so the batches don't change with the threads
+BWA_BATCH_BASES = 10000000
+
+
+def is_gzipped(file: str) -> bool:
+    with open(file, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def sequence_lengths(file: str) -> np.ndarray:
+    '''
+    The lengths of the sequences of the records, from the newlines, the records must have four lines.
+    '''
+    lengths, pending, position = [], np.empty(0, dtype=np.int64), 0
+    with open(file, "rb") as f:
+        while chunk := f.read(CHUNK):
+            # the newlines of the records not ended in the chunks before are carried over
+            newlines = np.concatenate([pending, np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10) + position])
+            ended = len(newlines) // 4 * 4
+            lengths.append((newlines[1:ended:4] - newlines[:ended:4] - 1).astype(np.uint32))
+            pending = newlines[ended:]
+            position += len(chunk)
+    return np.concatenate(lengths) if lengths else np.empty(0, dtype=np.uint32)
+
+
+def batch_ends(bases: np.ndarray, batch_bases: int) -> np.ndarray:
+    '''
+    The indices past the last units of the batches `bwa mem -K` reads, by the bases of each unit.
+
+    bwa ends a batch once it has read `batch_bases` and an even number of reads,
+    the units are the pairs of mates, or two reads one after another if not paired.
+    '''
+    total = np.cumsum(bases, dtype=np.int64)
+    ends, read = [], 0
+    while (end := int(np.searchsorted(total, read + batch_bases))) < len(total) - 1:
+        ends.append(end + 1)
+        read = total[end]
+    return np.array(ends, dtype=np.int64)
+
+
+def line_offsets(file: str, lines: List[int]) -> List[int]:
+    '''
+    The byte offsets where the lines start, the lines must be ascending,
+    the ones past the last line are at the end of the file.
+    '''
+    offsets = []
+    wanted = iter(lines)
+    target = next(wanted, None)
+    count, position = 0, 0
+    with open(file, "rb") as f:
+        while target is not None and (chunk := f.read(CHUNK)):
+            newlines = chunk.count(b"\n")
+            # only the chunk holding a wanted line is searched for its newlines
+            while target is not None and count + newlines >= target:
+                index = -1
+                for _ in range(target - count):
+                    index = chunk.index(b"\n", index + 1)
+                offsets.append(position + index + 1)
+                target = next(wanted, None)
+            count += newlines
+            position += len(chunk)
+    return offsets + [position] * (len(lines) - len(offsets))
+
+
+def split_fastq(files: List[str], shards: int, batch_bases: int = BWA_BATCH_BASES) -> List[List[Tuple[int, int]]]:
+    '''
+    Split the fastq files into shards of about the same number of records, by the byte ranges of each file.
+
+    The shards are cut where `bwa mem -K batch_bases` ends a batch, so each shard reads the same batches
+    as a single `bwa mem` over all the records. The records must have four lines,
+    the files of paired reads are split at the same records.
+    '''
+    with ThreadPoolExecutor(len(files)) as pool:
+        lengths = list(pool.map(sequence_lengths, files))
+    records = min(len(x) for x in lengths)
+    if len(files) == 1:
+        bases, per_unit = np.add.reduceat(lengths[0], np.arange(0, records, 2)) if records else lengths[0], 2
+    else:
+        bases, per_unit = lengths[0][:records].astype(np.int64) + lengths[1][:records], 1
+    ends = batch_ends(bases, batch_bases) * per_unit
+    cuts = []
+    for x in range(1, shards):
+        # the batch end nearest to an even split, the shards are empty if there are fewer batches
+        target = records * x // shards
+        index = int(np.searchsorted(ends, target))
+        nearest = min(ends[max(index - 1, 0):index + 1], key=lambda y: abs(int(y) - target), default=records)
+        cuts.append(max(int(nearest), cuts[-1] if cuts else 0))
+    lines = [x * 4 for x in cuts]
+    with ThreadPoolExecutor(len(files)) as pool:
+        offsets = list(pool.map(lambda x: [0] + line_offsets(x, lines) + [os.path.getsize(x)], files))
+    return [[(x[i], x[i + 1]) for x in offsets] for i in range(shards)]
+
+
+def write_ranges(files: List[str], shards: int, output: str, batch_bases: int = BWA_BATCH_BASES):
+    with open(output, "w") as f:
+        json.dump(split_fastq(files, shards, batch_bases), f)
+
+
+def copy_range(file: str, start: int, end: int, output: BinaryIO):
+    with open(file, "rb") as f:
+        f.seek(start)
+        while start < end and (chunk := f.read(min(CHUNK, end - start))):
+            output.write(chunk)
+            start += len(chunk)
+
+
+def interleave_range(fq1: str, range1: Tuple[int, int], fq2: str, range2: Tuple[int, int], output: BinaryIO):
+    '''
+    Write the paired records of the ranges one after another, as `bwa mem -p` reads them.
+    '''
+    with open(fq1, "rb", buffering=CHUNK) as f1, open(fq2, "rb", buffering=CHUNK) as f2:
+        f1.seek(range1[0])
+        f2.seek(range2[0])
+        left = range1[1] - range1[0]
+        while left > 0:
+            record = f1.readline() + f1.readline() + f1.readline() + f1.readline()
+            if not record:
+                break
+            left -= len(record)
+            output.write(record)
+            output.write(f2.readline() + f2.readline() + f2.readline() + f2.readline())
+
+
+def read_shard(files: List[str], ranges: str, shard: int, output: BinaryIO):
+    with open(ranges) as f:
+        spans = json.load(f)[shard]
+    if len(files) == 1:
+        copy_range(files[0], *spans[0], output)
+    else:
+        interleave_range(files[0], spans[0], files[1], spans[1], output)
+
+
+def concat_sam(files: List[str], output: str):
+    '''
+    Concatenate the SAM of the shards, with the header of the first one.
+    '''
+    with open(output, "wb") as out:
+        for i, file in enumerate(files):
+            with open(file, "rb") as f:
+                line = f.readline()
+                while i and line.startswith(b"@"):
+                    line = f.readline()
+                out.write(line)
+                while chunk := f.read(CHUNK):
+                    out.write(chunk)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="split the fastq files into shards without copying them")
+    commands = parser.add_subparsers(dest="command", required=True)
+    split = commands.add_parser("split", help="write the byte ranges of the shards as JSON")
+    split.add_argument("files", nargs="+", help="the fastq, or the two fastq of paired reads")
+    split.add_argument("-n", "--shards", type=int, required=True, help="the number of shards")
+    split.add_argument("-K", "--batch-bases", type=int, default=BWA_BATCH_BASES,
+                       help="the bases bwa mem reads in a batch, the shards are cut between the batches")
+    split.add_argument("-o", "--output", default="/dev/stdout", help="the output path, leave out to stdout")
+    read = commands.add_parser("read", help="write the records of a shard to stdout, interleaved if paired")
+    read.add_argument("files", nargs="+", help="the fastq, or the two fastq of paired reads")
+    read.add_argument("-r", "--ranges", required=True, help="the ranges written by split")
+    read.add_argument("-s", "--shard", type=int, required=True, help="the shard to write")
+    args = parser.parse_args()
+
+    if args.command == "split":
+        write_ranges(args.files, args.shards, args.output, args.batch_bases)
+    else:
+        read_shard(args.files, args.ranges, args.shard, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
@@ -0,0 +1,115 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from os import path
+from typing import Optional
+
+from utils import async_pipeline, bwa_index_files
+from wdp.runner.cache import fingerprint
+from wdp.runner.profiler import run_in_thread
+
+
+class IndexStore():
+    '''
+    A directory of bwa indexes shared across working directories,
+    each index is keyed by the sha1 of the reference it was built from.
+    '''
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def prefix(self, digest: str) -> str:
+        return path.join(self.root, digest, "db")
+
+    @contextmanager
+    def locked(self, name: str):
+        '''
+        Hold the lock file of the name in the store, the concurrent runs wait for each other.
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        lock = os.open(path.join(self.root, f"{name}.lock"), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            os.close(lock)
+
+    def read_checksums(self) -> dict:
+        known = path.join(self.root, "checksums.json")
+        if not path.isfile(known):
+            return {}
+        with open(known) as f:
+            return json.load(f)
+
+    def checksum(self, fasta: str) -> str:
+        '''
+        Hash the reference, the result is remembered by its size and mtime
+        so the multi-GB genomes are not read again on every run.
+        '''
+        source = path.realpath(fasta)
+        stat = fingerprint(source)
+        with self.locked("checksums"):
+            checksums = self.read_checksums()
+        if source in checksums and checksums[source]["stat"] == stat:
+            return checksums[source]["sha1"]
+
+        digest = hashlib.sha1()
+        with open(source, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+
+        # read again under the lock, so the entries written by the concurrent runs meanwhile are kept
+        known = path.join(self.root, "checksums.json")
+        with self.locked("checksums"):
+            checksums = self.read_checksums()
+            checksums[source] = {"stat": stat, "sha1": digest.hexdigest()}
+            temp = f"{known}.{os.getpid()}"
+            with open(temp, "w") as f:
+                json.dump(checksums, f, indent=2)
+            os.replace(temp, known)
+        return digest.hexdigest()
+
+    def lookup(self, fasta: str) -> Optional[str]:
+        '''
+        Get the prefix of the index built from the reference, or None if there is none.
+        '''
+        prefix = self.prefix(self.checksum(fasta))
+        return prefix if all(path.isfile(x) for x in bwa_index_files(prefix)) else None
+
+    async def ensure(self, fasta: str, bwa_binary: str) -> str:
+        '''
+        Get the prefix of the index built from the reference, build it if there is none.
+
+        The build is guarded by a lock file, so concurrent runs on the same reference
+        will wait for the first one instead of building the index again.
+        '''
+        loop = asyncio.get_event_loop()
+        digest = await run_in_thread(self.checksum, fasta)
+        prefix = self.prefix(digest)
+        if await run_in_thread(self.lookup, fasta):
+            return prefix
+
+        os.makedirs(self.root, exist_ok=True)
+        lock = os.open(path.join(self.root, f"{digest}.lock"), os.O_CREAT | os.O_RDWR)
+        try:
+            await loop.run_in_executor(None, fcntl.flock, lock, fcntl.LOCK_EX)
+            if path.isdir(path.dirname(prefix)):
+                return prefix
+
+            # built aside and renamed, so a half-built index is never visible
+            building = path.join(self.root, f"{digest}.building")
+            shutil.rmtree(building, ignore_errors=True)
+            os.makedirs(building)
+            await async_pipeline([bwa_binary, "index", "-p", path.join(building, "db"), fasta])
+            with open(path.join(building, "source.json"), "w") as f:
+                json.dump({"fasta": path.realpath(fasta), "sha1": digest}, f, indent=2)
+            os.rename(building, path.dirname(prefix))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            os.close(lock)
+        return prefix
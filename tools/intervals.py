@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from tools.tsv import read_batches
+from tools.xopen import xopen
+
+
+def parse_genepred(line: bytes, exons: bool = True) -> Optional[Tuple[bytes, List[Tuple[int, int]], bytes]]:
+    '''
+    The chromosome, the exons or the transcript, and the name of a GenePred record, None if it's not one.
+
+    The strand tells the columns, so the extended GenePred with the gene name first is read too.
+    '''
+    fields = line.rstrip(b"\r\n").split(b"\t")
+    strand = next((i for i in (2, 3) if len(fields) > i + 7 and fields[i] in (b"+", b"-")), None)
+    if strand is None:
+        return None
+    chromosome, name = fields[strand - 1], fields[strand - 2]
+    if not exons:
+        return chromosome, [(int(fields[strand + 1]), int(fields[strand + 2]))], name
+    starts = [int(x) for x in fields[strand + 6].split(b",") if x]
+    ends = [int(x) for x in fields[strand + 7].split(b",") if x]
+    return chromosome, list(zip(starts, ends)), name
+
+
+class IntervalIndex():
+    '''
+    The half open intervals of each chromosome, as sorted arrays for batched queries by `np.searchsorted`.
+
+    The intervals are flat arrays ordered by chromosome and start, `offsets` slices them by chromosome.
+    Alongside are the ends sorted on their own for counting, and the running max of the ends for overlaps.
+    '''
+
+    FIELDS = ("chromosomes", "offsets", "starts", "ends", "names", "sorted_ends", "max_ends")
+
+    def __init__(self, chromosomes: np.ndarray, offsets: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                 names: np.ndarray, sorted_ends: np.ndarray = None, max_ends: np.ndarray = None) -> None:
+        self.chromosomes = chromosomes
+        self.offsets = offsets
+        self.starts = starts
+        self.ends = ends
+        self.names = names
+        self.slices = {x: slice(offsets[i], offsets[i + 1]) for i, x in enumerate(chromosomes.tolist())}
+        if sorted_ends is None:
+            sorted_ends, max_ends = np.empty_like(ends), np.empty_like(ends)
+            for span in self.slices.values():
+                sorted_ends[span] = np.sort(ends[span])
+                max_ends[span] = np.maximum.accumulate(ends[span])
+        self.sorted_ends = sorted_ends
+        self.max_ends = max_ends
+
+    @classmethod
+    def build(cls, intervals: Dict[bytes, Tuple[List[int], List[int], List[bytes]]]) -> "IntervalIndex":
+        '''
+        Build from the starts, ends and names of the intervals on each chromosome, in any order.
+        '''
+        chromosomes = sorted(intervals)
+        starts, ends, names, offsets = [], [], [], [0]
+        for chromosome in chromosomes:
+            s, e, n = (np.asarray(x) for x in intervals[chromosome])
+            order = np.lexsort((e, s))
+            starts.append(s[order].astype(np.int64))
+            ends.append(e[order].astype(np.int64))
+            names.append(n[order].astype(bytes))
+            offsets.append(offsets[-1] + len(order))
+        concat = lambda x, dtype: np.concatenate(x) if x else np.empty(0, dtype=dtype)
+        return cls(np.array(chromosomes, dtype=bytes), np.array(offsets, dtype=np.int64),
+                   concat(starts, np.int64), concat(ends, np.int64), concat(names, bytes))
+
+    @classmethod
+    def from_genepred(cls, file: str, exons: bool = True) -> "IntervalIndex":
+        '''
+        Index the exons of each transcript in a GenePred file, or the transcripts themselves.
+        '''
+        intervals: Dict[bytes, Tuple[List[int], List[int], List[bytes]]] = {}
+        with xopen(file) as f:
+            for line in f:
+                record = parse_genepred(line, exons)
+                if record is None:
+                    continue
+                chromosome, spans, name = record
+                starts, ends, names = intervals.setdefault(chromosome, ([], [], []))
+                for start, end in spans:
+                    starts.append(start)
+                    ends.append(end)
+                    names.append(name)
+        return cls.build(intervals)
+
+    @classmethod
+    def from_pairs(cls, file: str) -> "IntervalIndex":
+        '''
+        Index the regions of a `.pairs` file, the chromosome, start and end in the first columns.
+        The regions are named by their line numbers.
+        '''
+        chromosomes, starts, ends = [], [], []
+        for batch in read_batches(file):
+            chromosomes.append(batch.field(0))
+            starts.append(batch.ints(1))
+            ends.append(batch.ints(2))
+        if not chromosomes:
+            return cls.build({})
+        chromosomes, starts, ends = np.concatenate(chromosomes), np.concatenate(starts), np.concatenate(ends)
+        numbers = np.arange(len(chromosomes)).astype(bytes)
+        return cls.build({x: (starts[chromosomes == x], ends[chromosomes == x], numbers[chromosomes == x])
+                          for x in np.unique(chromosomes).tolist()})
+
+    @classmethod
+    def load(cls, file: str) -> "IntervalIndex":
+        with np.load(file) as data:
+            return cls(*(data[x] for x in cls.FIELDS))
+
+    @classmethod
+    def cached(cls, file: str, genepred: bool = True) -> "IntervalIndex":
+        '''
+        The index of a GenePred or `.pairs` file, cached in `<file>.npz` and built again only if the file is newer.
+        '''
+        npz = f"{file}.npz"
+        if os.path.isfile(npz) and os.stat(npz).st_mtime_ns >= os.stat(file).st_mtime_ns:
+            return cls.load(npz)
+        index = cls.from_genepred(file) if genepred else cls.from_pairs(file)
+        index.save(npz)
+        return index
+
+    def save(self, file: str):
+        # written aside and renamed, np.savez adds `.npz` to the names without it
+        temp = f"{file}.{os.getpid()}.npz"
+        np.savez(temp, **{x: getattr(self, x) for x in self.FIELDS})
+        os.replace(temp, file)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __contains__(self, chromosome: bytes) -> bool:
+        return chromosome in self.slices
+
+    def span(self, chromosome: bytes) -> slice:
+        return self.slices.get(chromosome, slice(0, 0))
+
+    def count(self, chromosome: bytes, starts: Iterable[int], ends: Iterable[int]) -> np.ndarray:
+        '''
+        The number of intervals overlapping each query, the queries are half open too, and the empty ones overlap none.
+        '''
+        span = self.span(chromosome)
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        # the ones starting before the query ends, but not those ended before it starts
+        before = np.searchsorted(self.starts[span], ends, side="left")
+        ended = np.searchsorted(self.sorted_ends[span], starts, side="right")
+        return np.maximum(before - ended, 0) * (starts < ends)
+
+    def overlaps(self, chromosome: bytes, starts: Iterable[int], ends: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        The overlapping pairs of the queries and the intervals, as the indices of the queries
+        and the indices of the intervals in this index.
+        '''
+        span = self.span(chromosome)
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        # the candidates are from the first interval with a max end past the query start,
+        # to the last one starting before the query end
+        lower = np.searchsorted(self.max_ends[span], starts, side="right")
+        upper = np.maximum(np.searchsorted(self.starts[span], ends, side="left"), lower)
+        sizes = upper - lower
+        queries = np.repeat(np.arange(len(starts)), sizes)
+        candidates = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes) + np.repeat(lower, sizes)
+        hit = (self.ends[span][candidates] > starts[queries]) & (starts[queries] < ends[queries])
+        return queries[hit], candidates[hit] + span.start
+
+    def contains(self, chromosome: bytes, positions: Iterable[int]) -> np.ndarray:
+        '''
+        If each position is in any of the intervals.
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        return self.count(chromosome, positions, positions + 1) > 0
+
+    def boundaries(self, chromosome: bytes) -> np.ndarray:
+        '''
+        The sorted starts and ends of the intervals, like the splice sites of the exons.
+        '''
+        span = self.span(chromosome)
+        return np.union1d(self.starts[span], self.ends[span])
+
+    def nearest(self, chromosome: bytes, positions: Iterable[int]) -> np.ndarray:
+        '''
+        The distance from each position to the nearest boundary, -1 if the chromosome has no intervals.
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        bounds = self.boundaries(chromosome)
+        if not len(bounds):
+            return np.full(len(positions), -1, dtype=np.int64)
+        right = np.clip(np.searchsorted(bounds, positions), 0, len(bounds) - 1)
+        left = np.clip(right - 1, 0, len(bounds) - 1)
+        return np.minimum(np.abs(bounds[right] - positions), np.abs(positions - bounds[left]))
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="index the intervals of a GenePred or pairs file, and query the regions of a pairs file")
+    parser.add_argument("file", help="the GenePred or pairs file to index, gzipped or not")
+    parser.add_argument("-p", "--pairs", action="store_true", help="index the regions of a pairs file instead")
+    parser.add_argument("-q", "--query", default=None,
+                        help="the pairs file whose regions are queried, each is written with the count of the intervals it overlaps")
+    args = parser.parse_args()
+
+    index = IntervalIndex.cached(args.file, genepred=not args.pairs)
+    if args.query is None:
+        print(f"{len(index)} intervals on {len(index.chromosomes)} chromosomes, saved to {args.file}.npz")
+        sys.exit(0)
+    query = IntervalIndex.from_pairs(args.query)
+    out = sys.stdout.buffer
+    for chromosome in query.chromosomes.tolist():
+        span = query.span(chromosome)
+        counts = index.count(chromosome, query.starts[span], query.ends[span])
+        for start, end, count in zip(query.starts[span].tolist(), query.ends[span].tolist(), counts.tolist()):
+            out.write(b"%s\t%d\t%d\t%d\n" % (chromosome, start, end, count))
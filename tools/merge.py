@@ -1,14 +1,91 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
-import fileinput
-
-existed = defaultdict(int)
-for line in map(str.rstrip, fileinput.input()):
-    line: str
-    striped, depth = line.rsplit(maxsplit=1, sep="\t")
-    existed[striped] += int(depth)
-sorted = list(existed.items())
-# sorted.sort(key=lambda x: x[1], reverse=True)
-for x in sorted:
-    print(x[0], x[1], sep="\t")
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from argparse import ArgumentParser
+from typing import BinaryIO, Dict, Iterable, List
+
+import numpy as np
+
+from tools.pairs import format_columns, hash_names, mix
+from tools.tsv import Batch, read_batches
+from tools.xopen import xopen
+
+# the columns of `chimera annotate` before the depth, the hits are merged on all of them
+COLUMNS = ["chr", "start", "end", "type", "strand", "starts", "ends"]
+
+
+def parse_hits(batch: Batch) -> Dict[str, np.ndarray]:
+    '''
+    Parse a batch of annotated hits into columns, the coordinates and depths are parsed as integers.
+    '''
+    width = len(COLUMNS) + 1
+    if batch.width != width:
+        raise ValueError(f"The hits should have {width} columns, {', '.join(COLUMNS)} and depth.")
+    hits = {name: batch.field(i) for i, name in enumerate(COLUMNS) if name not in ("start", "end")}
+    hits["start"] = batch.ints(1)
+    hits["end"] = batch.ints(2)
+    hits["depth"] = batch.ints(len(COLUMNS))
+    return hits
+
+
+def hash_hits(hits: Dict[str, np.ndarray]) -> np.ndarray:
+    h = np.zeros(len(hits["depth"]), dtype=np.uint64)
+    for name in COLUMNS:
+        column = hits[name]
+        h = mix(h ^ (hash_names(column) if column.dtype.kind == "S" else column.astype(np.uint64)))
+    return h
+
+
+def merge_hits(hits: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    '''
+    Sum the depths of the hits sharing all the other columns,
+    the merged hits are kept in the order they first appear.
+    '''
+    if not len(hits["depth"]):
+        return hits
+    # a stable sort by the hash, so the first row of each group is the first to appear
+    order = np.argsort(hash_hits(hits), kind="stable")
+    changed = np.zeros(len(order) - 1, dtype=bool)
+    for name in COLUMNS:
+        column = hits[name][order]
+        changed |= column[1:] != column[:-1]
+    bounds = np.flatnonzero(np.append(True, changed))
+    depths = np.add.reduceat(hits["depth"][order], bounds)
+
+    firsts = order[bounds]
+    appeared = np.argsort(firsts)
+    merged = {name: hits[name][firsts[appeared]] for name in COLUMNS}
+    merged["depth"] = depths[appeared]
+    return merged
+
+
+def concat_hits(batches: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    return {name: np.concatenate([x[name] for x in batches]) for name in COLUMNS + ["depth"]}
+
+
+def merge_files(sources: Iterable[str], output: BinaryIO):
+    '''
+    Merge the annotated hits of the files, each batch is merged on its own before the final merge.
+    '''
+    batches = []
+    for source in sources:
+        for batch in read_batches(source):
+            batches.append(merge_hits(parse_hits(batch)))
+    if not batches:
+        return
+    merged = merge_hits(concat_hits(batches))
+    output.write(format_columns(*(merged[x] for x in COLUMNS), merged["depth"]))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="sum the depths of the same hits from chimera annotate")
+    parser.add_argument("files", nargs="*", default=["-"], help="the annotated hits, gzipped or not, leave out to stdin")
+    parser.add_argument("-o", "--output", default="-", help="the output path, gzipped if ends with .gz, leave out to stdout")
+    args = parser.parse_args()
+
+    with xopen(args.output, "wb") as f:
+        merge_files(args.files, f)
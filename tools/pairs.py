@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+from typing import TYPE_CHECKING, BinaryIO, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.xopen import xopen
+
+if TYPE_CHECKING:
+    from tools.tsv import Batch
+
+# the integer keys of a read on a junction, spilled to disk as is
+ROW = np.dtype([("k1", np.uint64), ("k2", np.uint64), ("h", np.uint64)])
+
+
+class Chromosomes():
+    '''
+    A dictionary encoding the chromosome names into integers.
+    '''
+
+    def __init__(self) -> None:
+        self.names: List[bytes] = []
+        self.ids: Dict[bytes, int] = {}
+
+    def encode(self, names: np.ndarray) -> np.ndarray:
+        # only a few distinct names, so unique on their hashes instead of the strings
+        _, first, inverse = np.unique(hash_names(names), return_index=True, return_inverse=True)
+        ids = np.empty(len(first), dtype=np.uint64)
+        for i, name in enumerate(names[first].tolist()):
+            if name not in self.ids:
+                self.ids[name] = len(self.names)
+                self.names.append(name)
+            ids[i] = self.ids[name]
+        return ids[inverse]
+
+    def ranks(self) -> np.ndarray:
+        '''
+        The bytewise order of each chromosome, indexed by its id.
+        '''
+        ranks = np.empty(len(self.names), dtype=np.uint64)
+        ranks[np.argsort(np.array(self.names, dtype=bytes), kind="stable")] = np.arange(len(self.names), dtype=np.uint64)
+        return ranks
+
+
+def mix(x: np.ndarray) -> np.ndarray:
+    '''
+    The splitmix64 finalizer, scrambles the bits of the uint64 array.
+    '''
+    with np.errstate(over="ignore"):
+        x = x ^ (x >> np.uint64(30))
+        x = x * np.uint64(0xbf58476d1ce4e5b9)
+        x = x ^ (x >> np.uint64(27))
+        x = x * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+def hash_names(names: np.ndarray) -> np.ndarray:
+    '''
+    Hash a fixed width bytes array into uint64, word by word.
+
+    The words of nulls are skipped, so a name hashes the same in arrays of any width.
+    '''
+    width = -(-names.dtype.itemsize // 8) * 8
+    padded = np.zeros((len(names), width), dtype=np.uint8)
+    padded[:, :names.dtype.itemsize] = names.view(np.uint8).reshape(len(names), -1)
+    words = padded.view(np.uint64)
+    h = np.full(len(names), 0x9e3779b97f4a7c15, dtype=np.uint64)
+    for i in range(words.shape[1]):
+        h = np.where(words[:, i] != 0, mix(h ^ words[:, i]), h)
+    return h
+
+
+def parse_ints(column: np.ndarray) -> np.ndarray:
+    '''
+    Parse a fixed width bytes array of decimals into int64, digit by digit.
+    '''
+    chars = column.view(np.uint8).reshape(len(column), -1)
+    values = np.zeros(len(column), dtype=np.int64)
+    negative = chars[:, 0] == ord("-")
+    for i in range(chars.shape[1]):
+        digit = chars[:, i].astype(np.int64) - ord("0")
+        valid = (digit >= 0) & (digit <= 9)
+        values = np.where(valid, values * 10 + digit, values)
+    return np.where(negative, -values, values)
+
+
+def format_ints(values: np.ndarray) -> np.ndarray:
+    '''
+    Format the integers into a (n, width) array of ascii digits, padded by leading nulls.
+    '''
+    values = values.astype(np.int64)
+    negative = values < 0
+    values = np.abs(values)
+    width = len(str(int(values.max()))) + 1 if len(values) else 1
+    chars = np.zeros((len(values), width), dtype=np.uint8)
+    for i in range(width - 1, -1, -1):
+        # leading zeros are left as nulls, but the last digit is always kept
+        leading = (values == 0) if i < width - 1 else np.zeros(len(values), dtype=bool)
+        chars[:, i] = np.where(leading, 0, values % 10 + ord("0"))
+        values = values // 10
+    sign = np.argmax(chars != 0, axis=1) - 1
+    rows = np.flatnonzero(negative)
+    chars[rows, sign[rows]] = ord("-")
+    return chars
+
+
+def read_blocks(handle: BinaryIO, size: int = 64 << 20) -> Iterator[bytes]:
+    '''
+    Read the file in blocks of whole lines.
+    '''
+    rest = b""
+    while chunk := handle.read(size):
+        chunk = rest + chunk
+        cut = chunk.rfind(b"\n") + 1
+        rest = chunk[cut:]
+        if cut:
+            yield chunk[:cut]
+    if rest:
+        yield rest + b"\n"
+
+
+def parse_pairs(batch: "Batch", chromosomes: Chromosomes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Parse a batch of `chr start end read` lines into the junction keys and the hashed read names.
+
+    The junction is packed into two words, the chromosome id with the start, and the end.
+    '''
+    if batch.width != 4:
+        raise ValueError("The pairs should have 4 columns, chr, start, end and read.")
+    starts = batch.ints(1).astype(np.uint64)
+    ends = batch.ints(2).astype(np.uint64)
+    if len(starts) and max(starts.max(), ends.max()) >> 32:
+        raise ValueError("The junction coordinates should fit into 32 bits.")
+    k1 = (chromosomes.encode(batch.field(0)) << np.uint64(32)) | starts
+    return k1, ends, hash_names(batch.field(3))
+
+
+def table_pairs(batch: Dict[str, np.ndarray], chromosomes: Chromosomes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    The junction keys and the hashed read names of a batch of the columnar pairs, as `parse_pairs`.
+    '''
+    starts, ends = batch["start"].astype(np.uint64), batch["end"].astype(np.uint64)
+    if len(starts) and max(starts.max(), ends.max()) >> 32:
+        raise ValueError("The junction coordinates should fit into 32 bits.")
+    k1 = (chromosomes.encode(batch["chr"]) << np.uint64(32)) | starts
+    return k1, ends, hash_names(batch["read"])
+
+
+def unique_rows(rows: np.ndarray) -> np.ndarray:
+    '''
+    Drop the duplicated rows, the rows are ordered by their hash so the duplicates are adjacent.
+    '''
+    rows = rows[np.argsort(mix(rows["k1"] ^ mix(rows["k2"] ^ mix(rows["h"]))))]
+    keep = np.ones(len(rows), dtype=bool)
+    keep[1:] = (rows["k1"][1:] != rows["k1"][:-1]) | (rows["k2"][1:] != rows["k2"][:-1]) | (rows["h"][1:] != rows["h"][:-1])
+    return rows[keep]
+
+
+def count_junctions(rows: np.ndarray) -> np.ndarray:
+    '''
+    Count the reads of each junction from the unique rows.
+    '''
+    rows = rows[np.argsort(mix(rows["k1"] ^ mix(rows["k2"])))]
+    starts = np.ones(len(rows), dtype=bool)
+    starts[1:] = (rows["k1"][1:] != rows["k1"][:-1]) | (rows["k2"][1:] != rows["k2"][:-1])
+    index = np.flatnonzero(starts)
+    counts = np.diff(np.append(index, len(rows)))
+    junctions = np.empty(len(index), dtype=[("k1", np.uint64), ("k2", np.uint64), ("count", np.uint64)])
+    junctions["k1"], junctions["k2"], junctions["count"] = rows["k1"][index], rows["k2"][index], counts
+    return junctions
+
+
+class PairsCounter():
+    '''
+    Count the unique reads of each junction.
+
+    The unique rows are kept in memory up to `max_rows`, beyond which they are spilled
+    into hash partitions under `temp_dir`, and each partition is counted on its own.
+    '''
+
+    def __init__(self, max_rows: int = 1 << 25, temp_dir: str = None, partitions: int = 64) -> None:
+        self.max_rows = max_rows
+        self.temp_dir = temp_dir
+        self.partitions = partitions
+        self.buffer: List[np.ndarray] = []
+        self.buffered = 0
+        self.spilled = None
+
+    def add(self, k1: np.ndarray, k2: np.ndarray, h: np.ndarray):
+        rows = np.empty(len(k1), dtype=ROW)
+        rows["k1"], rows["k2"], rows["h"] = k1, k2, h
+        rows = unique_rows(rows)
+        self.buffer.append(rows)
+        self.buffered += len(rows)
+        if self.buffered > self.max_rows:
+            self.compact()
+            if self.buffered > self.max_rows // 2:
+                self.spill()
+
+    def compact(self):
+        if len(self.buffer) == 1:
+            return
+        rows = unique_rows(np.concatenate(self.buffer)) if self.buffer else np.empty(0, dtype=ROW)
+        self.buffer, self.buffered = [rows], len(rows)
+
+    def spill(self):
+        if self.spilled is None:
+            self.spilled = tempfile.TemporaryDirectory(prefix="pairs.", dir=self.temp_dir)
+        if not self.buffer:
+            return
+        rows = np.concatenate(self.buffer)
+        part = mix(rows["k1"] ^ mix(rows["k2"])) % np.uint64(self.partitions)
+        order = np.argsort(part, kind="stable")
+        rows, part = rows[order], part[order]
+        bounds = np.searchsorted(part, np.arange(self.partitions + 1, dtype=np.uint64))
+        for i in range(self.partitions):
+            if bounds[i] < bounds[i + 1]:
+                with open(os.path.join(self.spilled.name, str(i)), "ab") as f:
+                    rows[bounds[i]:bounds[i + 1]].tofile(f)
+        self.buffer, self.buffered = [], 0
+
+    def junctions(self) -> np.ndarray:
+        if self.spilled is None:
+            self.compact()
+            return count_junctions(self.buffer[0])
+
+        self.spill()
+        counted = []
+        for i in range(self.partitions):
+            part = os.path.join(self.spilled.name, str(i))
+            if os.path.isfile(part):
+                counted.append(count_junctions(unique_rows(np.fromfile(part, dtype=ROW))))
+        self.spilled.cleanup()
+        self.spilled = None
+        return np.concatenate(counted) if counted else count_junctions(np.empty(0, dtype=ROW))
+
+
+def format_columns(*columns: np.ndarray) -> bytes:
+    '''
+    Format the columns into tab separated lines.
+
+    The columns are laid side by side as fixed width ascii, then the null paddings are dropped.
+    '''
+    columns = [x.view(np.uint8).reshape(len(x), x.dtype.itemsize) if x.dtype.kind == "S" else format_ints(x) for x in columns]
+    table = np.zeros((len(columns[0]), sum(x.shape[1] + 1 for x in columns)), dtype=np.uint8)
+    offset = 0
+    for column in columns:
+        table[:, offset:offset + column.shape[1]] = column
+        offset += column.shape[1] + 1
+        table[:, offset - 1] = ord("\t")
+    table[:, -1] = ord("\n")
+    return table[table != 0].tobytes()
+
+
+def decimal_order(values: np.ndarray) -> np.ndarray:
+    '''
+    A key ordering the integers below 10^10 like their decimal strings.
+    '''
+    values = values.astype(np.uint64)
+    digits = (np.searchsorted(10 ** np.arange(1, 10, dtype=np.uint64), values, side="right") + 1).astype(np.uint64)
+    # left align the digits, then the shorter one goes first on ties
+    return values * np.uint64(10) ** (np.uint64(10) - digits) * np.uint64(16) + digits
+
+
+def junction_columns(junctions: np.ndarray, chromosomes: Chromosomes) -> Dict[str, np.ndarray]:
+    '''
+    The columns of the junctions in the order `write_junctions` writes them.
+    '''
+    chrs = (junctions["k1"] >> np.uint64(32)).astype(np.int64)
+    starts = junctions["k1"] & np.uint64(0xffffffff)
+    # the decimal keys take 38 bits, so the chromosome rank fits above the start
+    order = np.lexsort((decimal_order(junctions["k2"]), chromosomes.ranks()[chrs] << np.uint64(38) | decimal_order(starts)))
+    names = np.array(chromosomes.names, dtype=bytes)
+    return {"chr": names[chrs[order]],
+            "start": starts[order], "end": junctions["k2"][order], "count": junctions["count"][order]}
+
+
+def write_junctions(junctions: np.ndarray, chromosomes: Chromosomes, output: BinaryIO):
+    '''
+    Write the junctions in the order of `LC_ALL=C sort`, as the text lines compare bytewise.
+    '''
+    columns = junction_columns(junctions, chromosomes)
+    output.write(format_columns(columns["chr"], columns["start"], columns["end"], columns["count"]))
+
+
+def dedup_pairs(sources: Iterable[str], output: str, max_rows: int = 1 << 25, temp_dir: str = None):
+    '''
+    Count the unique reads of each junction in the pairs files, like `sort | uniq.py` but in process.
+    The pairs can be gzipped or columnar tables, and the output is gzipped if it ends with `.gz`,
+    or a table if it ends with `.col`.
+    '''
+    from tools.columnar import SUFFIX, Table, TableWriter, is_table
+    from tools.tsv import read_batches
+
+    chromosomes = Chromosomes()
+    counter = PairsCounter(max_rows=max_rows, temp_dir=temp_dir)
+    for source in sources:
+        if is_table(source):
+            for batch in Table(source).batches():
+                counter.add(*table_pairs(batch, chromosomes))
+            continue
+        for batch in read_batches(source):
+            counter.add(*parse_pairs(batch, chromosomes))
+    if output.endswith(SUFFIX):
+        with TableWriter(output, ["chr", "start", "end", "count"]) as writer:
+            writer.write(junction_columns(counter.junctions(), chromosomes))
+        return
+    with xopen(output, "wb") as f:
+        write_junctions(counter.junctions(), chromosomes, f)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="count the unique reads of each junction in the pairs files")
+    parser.add_argument("files", nargs="+", help="the pairs files, gzipped or not")
+    parser.add_argument("-o", "--output", default="/dev/stdout", help="the output path, leave out to stdout")
+    parser.add_argument("--max-rows", type=int, default=1 << 25,
+                        help="the unique reads held in memory before spilling to disk")
+    parser.add_argument("--temp-dir", default=None, help="the directory to spill into")
+    args = parser.parse_args()
+    dedup_pairs(args.files, args.output, max_rows=args.max_rows, temp_dir=args.temp_dir)
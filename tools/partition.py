@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import shutil
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from typing import Dict, List, Optional
+
+from tools.xopen import xopen
+
+
+def genepred_chromosome(line: bytes) -> Optional[bytes]:
+    '''
+    The chromosome of a GenePred record, the one before the strand,
+    so the extended GenePred with the gene name first is read too.
+    '''
+    fields = line.split(b"\t", 4)
+    for i in (2, 3):
+        if len(fields) > i and fields[i] in (b"+", b"-"):
+            return fields[i - 1]
+    return None
+
+
+def count_chromosomes(file: str, chromosome) -> Dict[bytes, int]:
+    '''
+    The lines of each chromosome, in the order they first appear.
+    '''
+    counts: Dict[bytes, int] = {}
+    with xopen(file) as f:
+        for line in f:
+            name = chromosome(line)
+            if name is not None:
+                counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def assign_shards(weights: Dict[bytes, int], shards: int) -> Dict[bytes, int]:
+    '''
+    Cut the chromosomes into shards of about the same weight, keeping their order,
+    so the shards put one after another are in the order of the chromosomes.
+    '''
+    total = sum(weights.values()) or 1
+    result, before = {}, 0
+    for name, weight in weights.items():
+        result[name] = min(before * shards // total, shards - 1)
+        before += weight
+    return result
+
+
+def split_by_chromosome(juncs: str, reference: str, juncs_out: List[str], reference_out: List[str]):
+    '''
+    Partition the junctions and the GenePred records into the shards by their chromosomes.
+
+    The chromosomes are weighted by their junctions and genes, the genes on a chromosome with no junctions
+    are dropped, and the other lines of the reference, like the comments, are put in every shard.
+    '''
+    first = lambda line: line.split(b"\t", 1)[0] if line.strip() else None
+    weights = count_chromosomes(juncs, first)
+    for name, count in count_chromosomes(reference, genepred_chromosome).items():
+        if name in weights:
+            weights[name] += count
+    shard_of = assign_shards(weights, len(juncs_out))
+
+    for source, outputs, chromosome in ((juncs, juncs_out, first), (reference, reference_out, genepred_chromosome)):
+        files = [open(x, "wb") for x in outputs]
+        try:
+            with xopen(source) as f:
+                for line in f:
+                    name = chromosome(line)
+                    if name is None:
+                        for out in files:
+                            out.write(line)
+                    elif name in shard_of:
+                        files[shard_of[name]].write(line)
+        finally:
+            for out in files:
+                out.close()
+
+
+def concat(files: List[str], output: str):
+    with xopen(output, "wb") as out:
+        for file in files:
+            with open(file, "rb") as f:
+                shutil.copyfileobj(f, out, 1 << 20)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="partition the junctions and the GenePred reference by chromosome")
+    parser.add_argument("juncs", help="the junctions, gzipped or not")
+    parser.add_argument("reference", help="the reference in GenePred format, gzipped or not")
+    parser.add_argument("-n", "--shards", type=int, required=True, help="the number of shards")
+    parser.add_argument("-o", "--output", required=True,
+                        help="the prefix of the shards, written to <prefix>.<shard>.pairs and <prefix>.<shard>.gp")
+    args = parser.parse_args()
+    split_by_chromosome(args.juncs, args.reference,
+                        [f"{args.output}.{x}.pairs" for x in range(args.shards)],
+                        [f"{args.output}.{x}.gp" for x in range(args.shards)])
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+
+from tools.pairs import Chromosomes, format_columns
+from tools.xopen import xopen
+
+
+def read_regions(file: str) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    '''
+    The chromosomes, starts and ends of the regions in batches, from the first columns of a pairs file or a table.
+    '''
+    from tools.columnar import Table, is_table
+    from tools.tsv import read_batches
+
+    if is_table(file):
+        for batch in Table(file).batches():
+            yield batch["chr"], batch["start"].astype(np.int64), batch["end"].astype(np.int64)
+        return
+    for batch in read_batches(file):
+        yield batch.field(0), batch.ints(1), batch.ints(2)
+
+
+def merge_sorted(keys: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    '''
+    The indices of the first regions of the merged ones, the regions are sorted by the chromosome then the start,
+    packed into the keys as the high and the low 32 bits.
+
+    A region joins the one before if it starts before the end of the last region joined, as `chimera merge` does.
+    The merged region takes the end of the last one, not the furthest, so a break is where a region starts
+    at or past the end of the one right before it, or on another chromosome.
+    '''
+    breaks = np.ones(len(keys), dtype=bool)
+    starts = (keys & np.uint64(0xffffffff)).astype(np.uint32)
+    breaks[1:] = (ends[:-1] <= starts[1:]) | ((keys[1:] >> np.uint64(32)) != (keys[:-1] >> np.uint64(32)))
+    return np.flatnonzero(breaks)
+
+
+def merge_regions(sources: Iterable[str], output: str, min_len: int, max_len: int) -> int:
+    '''
+    Merge the overlapping regions of each chromosome longer than `min_len` and shorter than `max_len`,
+    like `chimera merge`, and return how many regions are merged into others.
+
+    The regions are sorted by chromosome then start at once, stable so the ties keep the order they are read in,
+    and the chromosomes are written in the bytewise order.
+    '''
+    chromosomes = Chromosomes()
+    ids, starts, ends = [], [], []
+    for source in sources:
+        for chrs, s, e in read_regions(source):
+            keep = (min_len < e - s) & (e - s < max_len)
+            ids.append(chromosomes.encode(chrs[keep]).astype(np.uint32))
+            # the coordinates fit into 32 bits, as checked when the pairs are counted
+            starts.append(s[keep].astype(np.uint32))
+            ends.append(e[keep].astype(np.uint32))
+
+    with xopen(output, "wb") as f:
+        if not chromosomes.names:
+            return 0
+        ranks = chromosomes.ranks()
+        keys = ranks[np.concatenate(ids)] << np.uint64(32) | np.concatenate(starts)
+        ends = np.concatenate(ends)
+        del ids, starts
+        order = np.argsort(keys, kind="stable")
+        keys, ends = keys[order], ends[order]
+        del order
+
+        first = merge_sorted(keys, ends)
+        last = np.append(first[1:], len(keys)) - 1
+        names = np.array(chromosomes.names, dtype=bytes)[np.argsort(ranks)]
+        for i in range(0, len(first), 1 << 22):
+            key = keys[first[i:i + (1 << 22)]]
+            f.write(format_columns(names[key >> np.uint64(32)], key & np.uint64(0xffffffff), ends[last[i:i + (1 << 22)]]))
+        return len(keys) - len(first)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="merge the overlapping regions of the pairs, like `chimera merge`")
+    parser.add_argument("-i", "--input", nargs="+", default=["-"], help="the pairs files or tables, leave out to stdin")
+    parser.add_argument("-o", "--output", default="/dev/stdout", help="the output path, leave out to stdout")
+    parser.add_argument("--min", type=int, required=True, help="the regions should be longer than it")
+    parser.add_argument("--max", type=int, required=True, help="the regions should be shorter than it")
+    args = parser.parse_args()
+
+    print(f"Merged {merge_regions(args.input, args.output, args.min, args.max)} regions.", file=sys.stderr)
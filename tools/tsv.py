@@ -0,0 +1,115 @@
+import mmap
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+
+from tools.pairs import parse_ints, read_blocks
+from tools.xopen import GZIP_MAGIC, xopen
+
+TAB, NEWLINE = ord("\t"), ord("\n")
+
+
+def gather(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    '''
+    The bytes of the spans of the buffer as a fixed width bytes array, padded by nulls.
+    '''
+    lengths = ends - starts
+    width = max(int(lengths.max()) if len(lengths) else 0, 1)
+    positions = np.arange(width)
+    chars = np.take(buffer, starts[:, None] + positions, mode="clip")
+    chars[positions >= lengths[:, None]] = 0
+    return chars.view(f"S{width}").reshape(-1)
+
+
+class Batch():
+    '''
+    A batch of the lines of a tab separated file, as the offsets of their fields into the buffer they are read from.
+
+    The fields are only copied out of the buffer when asked for, as columns.
+    '''
+
+    def __init__(self, buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> None:
+        self.buffer = buffer
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @property
+    def width(self) -> int:
+        return self.starts.shape[1]
+
+    def field(self, column: int) -> np.ndarray:
+        return gather(self.buffer, self.starts[:, column], self.ends[:, column])
+
+    def ints(self, column: int) -> np.ndarray:
+        return parse_ints(self.field(column))
+
+    def span(self, first: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        '''
+        The fields from `first` to before `stop` with the tabs between them, the whole lines by default.
+        '''
+        stop = self.width if stop is None else stop
+        return gather(self.buffer, self.starts[:, first], self.ends[:, stop - 1])
+
+
+def split_batches(buffer: np.ndarray, rows: int, width: Optional[int] = None) -> Iterator[Batch]:
+    '''
+    Split a buffer of whole lines into batches, by the positions of all the tabs and newlines at once.
+    '''
+    separators = np.flatnonzero((buffer == TAB) | (buffer == NEWLINE))
+    if not len(separators) or separators[-1] != len(buffer) - 1:
+        # the last line without a newline ends with the buffer
+        separators = np.append(separators, len(buffer))
+    if width is None:
+        newlines = buffer[separators[:-1]] == NEWLINE
+        width = int(np.argmax(newlines)) + 1 if newlines.any() else len(separators)
+    if len(separators) % width:
+        raise ValueError(f"The lines should all have {width} columns.")
+    ends = separators.reshape(-1, width)
+    inner = buffer[ends[:, :-1]] == TAB
+    last = np.append(buffer[ends[:-1, -1]], NEWLINE) == NEWLINE
+    if not (inner.all() and last.all()):
+        raise ValueError(f"The lines should all have {width} columns.")
+    starts = np.empty_like(ends)
+    starts[:, 1:] = ends[:, :-1] + 1
+    starts[0, 0] = 0
+    starts[1:, 0] = ends[:-1, -1] + 1
+    for i in range(0, len(ends), rows):
+        yield Batch(buffer, starts[i:i + rows], ends[i:i + rows])
+
+
+def read_batches(file: str, rows: int = 1 << 20, block: int = 64 << 20) -> Iterator[Batch]:
+    '''
+    Read a tab separated file in batches of rows, every line must have the same number of fields.
+
+    A plain file is memory mapped and split in place, a gzipped one or a stream is read in blocks of lines.
+    '''
+    mapped = None
+    if os.path.isfile(file) and os.path.getsize(file):
+        with open(file, "rb") as f:
+            if f.read(2) != GZIP_MAGIC:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped is None:
+        with xopen(file) as f:
+            width = None
+            for chunk in read_blocks(f, block):
+                for batch in split_batches(np.frombuffer(chunk, dtype=np.uint8), rows, width):
+                    width = batch.width
+                    yield batch
+        return
+
+    buffer = np.frombuffer(mapped, dtype=np.uint8)
+    width, start = None, 0
+    while start < len(buffer):
+        # cut the blocks at newlines, so the pages are parsed a block at a time
+        cut = mapped.rfind(b"\n", start, start + block) if start + block < len(buffer) else len(buffer) - 1
+        if cut < start:
+            cut = mapped.find(b"\n", start + block)
+        stop = len(buffer) if cut < 0 else cut + 1
+        for batch in split_batches(buffer[start:stop], rows, width):
+            width = batch.width
+            yield batch
+        start = stop
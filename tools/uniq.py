@@ -1,19 +1,98 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
-import fileinput
-
-existed = defaultdict(int)
-redundant = set()
-for line in map(str.rstrip, fileinput.input()):
-    line: str
-
-    # ignore the read names
-    striped = line.rsplit(maxsplit=1, sep="\t")[0]
-    if line not in redundant:
-        # tag all the reads
-        existed[striped] += 1
-        redundant.add(line)
-
-for k, v in existed.items():
-    print(k, v, sep="\t")
+from argparse import ArgumentParser
+from os import path
+import sys
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+
+from tools.pairs import format_columns, hash_names
+from tools.tsv import Batch, read_batches
+
+
+def strip(batch: Batch) -> Tuple[np.ndarray, np.ndarray]:
+    # ignore the read names, the last field
+    lines = batch.span()
+    return (batch.span(0, batch.width - 1) if batch.width > 1 else lines), lines
+
+
+def first_unique(values: np.ndarray) -> np.ndarray:
+    '''
+    The indices of the first occurrence of each value, in the order they appear.
+    '''
+    _, first = np.unique(values, return_index=True)
+    return np.sort(first)
+
+
+def count(batches: Iterable[Batch]) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Count the unique reads of each junction, in the order the junctions first appear.
+    The lines are told apart by their 64 bits hashes.
+    '''
+    keys, hashes = [], []
+    for batch in batches:
+        key, line = strip(batch)
+        # only the lines new to the batch are kept, so the duplicates take no memory
+        h = hash_names(line)
+        unique = first_unique(h)
+        keys.append(key[unique])
+        hashes.append(h[unique])
+    if not keys:
+        return np.empty(0, dtype="S1"), np.empty(0, dtype=np.int64)
+    keys = np.concatenate(keys)[first_unique(np.concatenate(hashes))]
+    _, first, inverse = np.unique(hash_names(keys), return_index=True, return_inverse=True)
+    counts = np.bincount(inverse.reshape(-1))
+    order = np.argsort(first)
+    return keys[first[order]], counts[order]
+
+
+def count_sorted(batches: Iterable[Batch]) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    '''
+    Count the reads of a bytewise sorted input, like the output of `LC_ALL=C sort`.
+
+    The junctions of each batch are emitted once the next one starts, so only a batch is held in memory.
+    '''
+    last_key, last_line, depth = None, b"", 0
+    for batch in batches:
+        keys, lines = strip(batch)
+        previous = np.concatenate([np.array([last_line]), lines[:-1]])
+        unsorted = np.flatnonzero(lines < previous)
+        if len(unsorted):
+            raise ValueError(f"The input is not sorted at \"{lines[unsorted[0]].decode()}\", sort it with LC_ALL=C.")
+
+        new_line = lines != previous
+        new_key = np.ones(len(keys), dtype=bool)
+        new_key[1:] = keys[1:] != keys[:-1]
+        if last_key is not None:
+            new_key[0] = keys[0] != last_key
+
+        # the lines before the first new junction are of the last one of the previous batch
+        starts = np.flatnonzero(new_key)
+        depth += int(new_line[:starts[0] if len(starts) else len(keys)].sum())
+        if len(starts):
+            depths = np.add.reduceat(new_line.astype(np.int64), starts)
+            done_keys, done_depths = keys[starts[:-1]], depths[:-1]
+            if last_key is not None:
+                done_keys, done_depths = np.concatenate([np.array([last_key]), done_keys]), np.append(depth, done_depths)
+            yield done_keys, done_depths
+            last_key, depth = keys[starts[-1]], int(depths[-1])
+        last_line = lines[-1]
+    if last_key is not None:
+        yield np.array([last_key]), np.array([depth])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="count the unique reads of each junction")
+    parser.add_argument("files", nargs="*", default=["-"], help="the pairs files, gzipped or not, leave out to stdin")
+    parser.add_argument("--sorted", action="store_true",
+                        help="the input is sorted, count it in a streaming way with bounded memory")
+    args = parser.parse_args()
+
+    batches = (x for file in args.files for x in read_batches(file))
+    for keys, counts in (count_sorted(batches) if args.sorted else [count(batches)]):
+        if len(keys):
+            sys.stdout.buffer.write(format_columns(keys, counts))
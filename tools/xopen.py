@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import gzip
+import io
+import struct
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Deque
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# the uncompressed bytes of a BGZF block, so the compressed one always fits in 64KB
+BGZF_BLOCK = 0xff00
+BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def bgzf_block(data: bytes, level: int) -> bytes:
+    '''
+    Compress the bytes into a BGZF block, a gzip member with its size in the extra field.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2,
+                              BGZF_HEADER.size + len(deflated) + 8 - 1)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+class BgzfWriter(io.RawIOBase):
+    '''
+    Write BGZF, the blocked gzip of samtools and tabix, readable by any gzip reader.
+
+    The blocks are independent, so they are compressed in a pool of threads,
+    zlib releases the GIL while it works. They are written in order as they are done.
+    '''
+
+    def __init__(self, raw: BinaryIO, level: int = 6, threads: int = 1) -> None:
+        super().__init__()
+        self.raw = raw
+        self.level = level
+        self.buffer = bytearray()
+        self.threads = max(threads, 1)
+        self.pool = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self.pending: Deque[Future] = deque()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK:
+            self._submit(bytes(self.buffer[:BGZF_BLOCK]))
+            del self.buffer[:BGZF_BLOCK]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        if self.pool is None:
+            self.raw.write(bgzf_block(block, self.level))
+            return
+        self.pending.append(self.pool.submit(bgzf_block, block, self.level))
+        # bound the blocks in flight, and write the finished ones in order
+        while len(self.pending) > self.threads * 4 or (self.pending and self.pending[0].done()):
+            self.raw.write(self.pending.popleft().result())
+
+    def flush(self):
+        # the bytes short of a block are kept, so flushing never writes tiny blocks
+        if self.closed:
+            return
+        while self.pending:
+            self.raw.write(self.pending.popleft().result())
+        self.raw.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            self.flush()
+            self.raw.write(BGZF_EOF)
+            self.raw.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+            # closing flushes once more, so the raw file is closed after
+            super().close()
+            if self.raw is not sys.stdout.buffer:
+                self.raw.close()
+
+
+def xopen(file: str, mode: str = "rb", level: int = 6, threads: int = 1) -> BinaryIO:
+    '''
+    Open a file in binary mode, gzipped or not.
+
+    Reading detects gzip by its magic bytes, BGZF included as it's gzip of many members.
+    Writing compresses into BGZF with `threads` if the path ends with `.gz`,
+    and `-` stands for stdin or stdout.
+    '''
+    if file == "-":
+        if "r" not in mode:
+            return sys.stdout.buffer
+        stdin = sys.stdin.buffer
+        return gzip.GzipFile(fileobj=stdin) if stdin.peek(2)[:2] == GZIP_MAGIC else stdin
+    if "r" in mode:
+        # opened once and peeked, as a FIFO can't be read again
+        f = open(file, "rb")
+        return gzip.GzipFile(fileobj=f) if f.peek(2)[:2] == GZIP_MAGIC else f
+    if file.endswith(".gz"):
+        return io.BufferedWriter(BgzfWriter(open(file, mode.replace("t", "")), level, threads), 1 << 20)
+    return open(file, mode)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="compress or decompress gzip and BGZF streams")
+    parser.add_argument("files", nargs="*", default=["-"], help="the inputs, gzipped or not, leave out to stdin")
+    parser.add_argument("-o", "--output", default="-", help="the output path, leave out to stdout")
+    parser.add_argument("-d", "--decompress", action="store_true", help="write the inputs decompressed")
+    parser.add_argument("-l", "--level", type=int, default=6, help="the compression level")
+    parser.add_argument("-@", "--threads", type=int, default=1, help="the threads compressing the blocks")
+    args = parser.parse_args()
+
+    if args.decompress:
+        output = xopen(args.output, "wb")
+    else:
+        raw = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        output = io.BufferedWriter(BgzfWriter(raw, args.level, args.threads), 1 << 20)
+    for file in args.files:
+        with xopen(file) as f:
+            while chunk := f.read(1 << 20):
+                output.write(chunk)
+    if output is sys.stdout.buffer:
+        output.flush()
+    else:
+        output.close()
@@ -1,5 +1,15 @@
 import asyncio
-from subprocess import STDOUT
+import os
+import resource
+import shlex
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from typing import List, Optional, Sequence
+
+from wdp.runner.profiler import record_process
 
 
 async def async_system(command: str, debug=True) -> int:
@@ -12,3 +22,232 @@ async def async_system(command: str, debug=True) -> int:
     proc = await asyncio.create_subprocess_shell(command)
     await proc.wait()
     return proc.returncode
+
+
+def bwa_index_files(prefix: str) -> List[str]:
+    '''
+    The files written by `bwa index -p prefix`.
+    '''
+    return [prefix + x for x in (".amb", ".ann", ".bwt", ".pac", ".sa")]
+
+
+class ProcessStats():
+    '''
+    The exit status and resource usage of a process in a pipeline,
+    with the bytes it wrote to the next process if the pipe is metered.
+    '''
+
+    def __init__(self, argv: Sequence[str]) -> None:
+        self.argv = list(argv)
+        self.returncode: Optional[int] = None
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.max_rss = 0
+        self.elapsed = 0.0
+        self.bytes_out: Optional[int] = None
+        self.relay_time = 0.0
+
+
+class PipelineError(Exception):
+    '''
+    Some processes of a pipeline failed.
+    '''
+
+    def __init__(self, stats: List[ProcessStats]) -> None:
+        self.stats = stats
+        failed = [x for x in stats if x.returncode]
+        super().__init__("; ".join(f"`{shlex.join(x.argv)}` exited with {x.returncode}" for x in failed))
+
+
+async def wait4(pid: int):
+    '''
+    Wait for the child and reap it with its resource usage, which `waitpid` would have dropped.
+    '''
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        fd = None
+
+    if fd is not None:
+        # the pidfd turns readable once the child exits
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+        return os.wait4(pid, 0)
+
+    reaped = loop.create_future()
+
+    def reap():
+        result = os.wait4(pid, 0)
+        loop.call_soon_threadsafe(lambda: reaped.done() or reaped.set_result(result))
+    threading.Thread(target=reap, daemon=True).start()
+    return await reaped
+
+
+def peak_rss(pid: int) -> int:
+    '''
+    The peak RSS of a running process in bytes, 0 if it's gone.
+    '''
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def relay(source: int, sink: int, stats: ProcessStats):
+    '''
+    Move the bytes between two pipes and count them, with splice so they never enter userspace.
+    '''
+    started = time.monotonic()
+    moved = 0
+    try:
+        while True:
+            if hasattr(os, "splice"):
+                n = os.splice(source, sink, 1 << 20)
+            else:
+                chunk = os.read(source, 1 << 20)
+                n = len(chunk)
+                while chunk:
+                    chunk = chunk[os.write(sink, chunk):]
+            if not n:
+                break
+            moved += n
+    except BrokenPipeError:
+        # the next process stopped reading, the previous one will get SIGPIPE
+        pass
+    finally:
+        os.close(source)
+        os.close(sink)
+        stats.bytes_out = moved
+        stats.relay_time = time.monotonic() - started
+
+
+class Pipeline():
+    '''
+    Processes connected by OS pipes, like `a | b | c < input > output` but without a shell.
+
+    Each process is reaped on its own, so the exit status, the CPU time and the max RSS
+    of every one of them are known, and the pipes can be metered to get the bytes between them.
+    '''
+
+    def __init__(self, *commands: Sequence[str], stdin: str = None, stdout: str = None, meter: bool = True) -> None:
+        self.commands = [[str(x) for x in command] for command in commands]
+        self.stdin = stdin
+        self.stdout = stdout
+        self.meter = meter
+        self.stats = [ProcessStats(x) for x in self.commands]
+
+    def __str__(self) -> str:
+        line = " | ".join(shlex.join(x) for x in self.commands)
+        if self.stdin:
+            line += f" < {shlex.quote(self.stdin)}"
+        if self.stdout:
+            line += f" > {shlex.quote(self.stdout)}"
+        return line
+
+    async def watch(self, process: subprocess.Popen, stats: ProcessStats, started: float):
+        # the max RSS of a child starts from the RSS of its parent at fork and survives the exec,
+        # so below that the peak is sampled from /proc instead, which misses the very short ones
+        inherited = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        sampled, interval = 0, 0.1
+        exited = asyncio.ensure_future(wait4(process.pid))
+        while not exited.done():
+            sampled = max(sampled, peak_rss(process.pid))
+            await asyncio.wait({exited}, timeout=interval)
+            interval = min(interval * 2, 1.0)
+
+        _, status, usage = exited.result()
+        # reaped already, so Popen will not wait for it again
+        process.returncode = stats.returncode = os.waitstatus_to_exitcode(status)
+        stats.elapsed = time.monotonic() - started
+        stats.user_time, stats.system_time = usage.ru_utime, usage.ru_stime
+        stats.max_rss = (usage.ru_maxrss if usage.ru_maxrss > inherited else 0) * 1024 or sampled
+
+    async def run(self) -> List[ProcessStats]:
+        '''
+        Run the processes and wait for all of them, raises PipelineError if any of them fails.
+
+        A process killed by SIGPIPE is not a failure if all the processes after it succeeded,
+        as they just did not read all its output.
+        '''
+        for argv in self.commands:
+            # before any of them starts, so a missing binary never leaves a half run pipeline
+            if shutil.which(argv[0]) is None:
+                raise FileNotFoundError(f"binary is not valid at \"{argv[0]}\"")
+
+        loop = asyncio.get_running_loop()
+        processes: List[subprocess.Popen] = []
+        waiting: List[asyncio.Future] = []
+        stdin = open(self.stdin, "rb") if self.stdin else None
+        stdout = open(self.stdout, "wb") if self.stdout else None
+        # the read end of the previous pipe, owned here until the next process is started
+        source = None
+        try:
+            for i, (argv, stats) in enumerate(zip(self.commands, self.stats)):
+                last = i == len(self.commands) - 1
+                read, write = (None, stdout) if last else os.pipe()
+                processes.append(subprocess.Popen(argv, stdin=stdin if i == 0 else source, stdout=write))
+                waiting.append(asyncio.ensure_future(self.watch(processes[-1], stats, time.monotonic())))
+                if source is not None:
+                    os.close(source)
+                    source = None
+                if not last:
+                    os.close(write)
+                    if self.meter:
+                        relayed, sink = os.pipe()
+                        done = loop.create_future()
+                        threading.Thread(target=self._relay, args=(loop, done, read, sink, stats), daemon=True).start()
+                        waiting.append(done)
+                        read = relayed
+                source = read
+            await asyncio.gather(*waiting)
+        except BaseException:
+            if source is not None:
+                os.close(source)
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+            await asyncio.gather(*waiting, return_exceptions=True)
+            raise
+        finally:
+            for f in (stdin, stdout):
+                if f is not None:
+                    f.close()
+            for stats in self.stats:
+                record_process(vars(stats).copy())
+
+        for i, stats in enumerate(self.stats):
+            downstream_ok = all(not x.returncode for x in self.stats[i + 1:])
+            if stats.returncode and not (stats.returncode == -signal.SIGPIPE and downstream_ok):
+                raise PipelineError(self.stats)
+        return self.stats
+
+    @staticmethod
+    def _relay(loop: asyncio.AbstractEventLoop, done: asyncio.Future, source: int, sink: int, stats: ProcessStats):
+        try:
+            relay(source, sink, stats)
+        finally:
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+
+async def async_pipeline(*commands: Sequence[str], stdin: str = None, stdout: str = None, debug=True) -> int:
+    '''
+    Execute the commands as a pipeline, raises PipelineError if any of them fails.
+    The stats of the processes are recorded to the stage running it.
+
+    Returns 0 as a successful `async_system` would.
+    '''
+    pipeline = Pipeline(*commands, stdin=stdin, stdout=stdout)
+    if debug:
+        print(pipeline)
+    await pipeline.run()
+    return 0
@@ -1,13 +1,15 @@
 import sys
+from importlib import import_module
 from wdp.collector.model import NameSpace
-from wdp.cli.model import ArgGroup, Command
+from wdp.cli.model import ArgGroup, Command, LazyCommand
 from argparse import ArgumentParser, RawTextHelpFormatter
-from typing import Dict
+from typing import Dict, Union
 
-from wdp.runner.model import Runnable
+from wdp.runner.model import Conditional, Runnable
+from wdp.util.error import BinaryNotFoundError
 
 
-__registry__: Dict[str, Command] = {}
+__registry__: Dict[str, Union[Command, LazyCommand]] = {}
 __main__ = None
 
 
@@ -28,6 +30,27 @@ def command(name, help=None):
     return inner
 
 
+def lazy(name, module, help=None):
+    '''
+    Register a command by the module defining it, the module is imported only if the command is selected.
+    '''
+    __registry__.setdefault(name, LazyCommand(name, module, help))
+
+
+def resolve(name) -> Command:
+    '''
+    Get the registered command, import its module first if it is lazy.
+    '''
+    cmd = __registry__[name]
+    if isinstance(cmd, LazyCommand):
+        import_module(cmd.module)
+        # the command is registered again by the decorator on import
+        cmd = __registry__[name]
+        if isinstance(cmd, LazyCommand):
+            raise ImportError(f"Module {cmd.module} defines no command {name}.")
+    return cmd
+
+
 def inject_safe(namespace: NameSpace, inst):
     import sys
     try:
@@ -40,6 +63,15 @@ def inject_safe(namespace: NameSpace, inst):
     sys.exit()
 
 
+def check_safe(inst):
+    '''
+    Exit with the error emitted if the conditional command is not valid to run.
+    '''
+    if isinstance(inst, Conditional) and not inst.predicate():
+        print(inst.emit_error())
+        sys.exit(1)
+
+
 def main(program: str, command: Command) -> Runnable:
     '''
     Use a certain command as main entry of program, and run them
@@ -51,25 +83,48 @@ def main(program: str, command: Command) -> Runnable:
 
     inst = command.wrapped()
     inject_safe(namespace, inst)
+    check_safe(inst)
     return inst
 
 
 def commands(program: str, help: str) -> Runnable:
     '''
     Use the registered commands as subentries of program, and run them
+
+    Only the arguments of the selected command are assembled, the others are listed by their help.
     '''
+    argv = sys.argv[1:]
+    selected = argv[0] if argv and argv[0] in __registry__ else None
+
     parser = ArgumentParser(prog=program, description=help, formatter_class=RawTextHelpFormatter)
     subs = parser.add_subparsers(dest="!command")
-    for k, v in __registry__.items():
+    for k in list(__registry__):
+        if k != selected:
+            subs.add_parser(k, help=__registry__[k].help)
+            continue
+        v = resolve(k)
         parents = [x.assemble() for x in v.wrapped.__dict__.values() if isinstance(x, ArgGroup)]
         sub = subs.add_parser(v.name, parents=parents, help=v.help)
         v.assemble(sub)
+        selected_parser = sub
 
-    parsed_args = vars(parser.parse_args())
+    parsed_args = vars(parser.parse_args(argv))
     command_dest = parsed_args.pop("!command")
     if command_dest is None:
         parser.print_help()
         sys.exit()
-    inst = __registry__[command_dest].wrapped()
+    inst = resolve(command_dest).wrapped()
     inject_safe(NameSpace({k: v for k, v in parsed_args.items() if v is not None}), inst)
+    check_safe(inst)
+
+    # a missing binary is a usage error, reported like those found on parsing
+    run = inst.run
+
+    async def checked():
+        try:
+            return await run()
+        except BinaryNotFoundError as e:
+            selected_parser.error(str(e))
+
+    inst.run = checked
     return inst
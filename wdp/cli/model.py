@@ -118,3 +118,14 @@ class Command():
             if isinstance(v, ArgSpec):
                 v.assemble(k, to_attach)
         return to_attach
+
+
+class LazyCommand():
+    '''
+    Placeholder of a command not imported yet, only the name and help are known.
+    '''
+
+    def __init__(self, name: str, module: str, help=None) -> None:
+        self.name = name
+        self.module = module
+        self.help = help
@@ -0,0 +1,152 @@
+import math
+import os
+from contextvars import ContextVar
+from os import path
+from typing import Dict, Iterable, List, Optional
+
+from wdp.runner.profiler import record_allocation
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# v1 writes a page aligned 2^63 for no limit
+NO_LIMIT = 1 << 60
+
+# the memory granted to the stage running in the current task, 0 if not bounded
+current_memory: ContextVar[int] = ContextVar("current_memory", default=0)
+
+
+def read_text(file: str) -> Optional[str]:
+    try:
+        with open(file) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_dirs(controller: str, root: str = CGROUP_ROOT) -> List[str]:
+    '''
+    The directories of the cgroup of this process and of its ancestors, innermost first.
+
+    The unified hierarchy of cgroup v2 is under the root, the v1 controller has its own one in `root/controller`.
+    Only those mounted are returned, in a container the cgroup of the process is usually the root.
+    '''
+    v2 = path.isfile(path.join(root, "cgroup.controllers"))
+    mount = root if v2 else path.join(root, controller)
+    relative = "/"
+    for line in (read_text("/proc/self/cgroup") or "").splitlines():
+        _, controllers, cgroup = line.split(":", 2)
+        if (v2 and controllers == "") or (not v2 and controller in controllers.split(",")):
+            relative = cgroup
+            break
+    dirs = []
+    current = path.normpath(path.join(mount, relative.lstrip("/")))
+    while True:
+        if path.isdir(current):
+            dirs.append(current)
+        if current == mount or not current.startswith(mount):
+            break
+        current = path.dirname(current)
+    if mount not in dirs and path.isdir(mount):
+        dirs.append(mount)
+    return dirs
+
+
+def cgroup_cpus(root: str = CGROUP_ROOT) -> Optional[float]:
+    '''
+    The CPUs granted by the cgroup quotas, the tightest of the cgroup and its ancestors, None if there is no quota.
+    '''
+    quotas = []
+    for directory in cgroup_dirs("cpu", root):
+        # v2 writes `$MAX $PERIOD` with `max` for no quota, v1 a quota of -1
+        text = read_text(path.join(directory, "cpu.max"))
+        if text is not None:
+            quota, period = (text.split() + ["100000"])[:2]
+        else:
+            quota, period = read_text(path.join(directory, "cpu.cfs_quota_us")), \
+                read_text(path.join(directory, "cpu.cfs_period_us"))
+        if quota is None or period is None or quota == "max" or int(quota) <= 0 or int(period) <= 0:
+            continue
+        quotas.append(int(quota) / int(period))
+    return min(quotas) if quotas else None
+
+
+def available_cpus() -> int:
+    '''
+    The CPUs this process can use, `os.cpu_count` counts those of the host,
+    while a container is limited by its CPU set and its cgroup quota.
+    '''
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    quota = cgroup_cpus()
+    return max(1, min(cpus, math.ceil(quota))) if quota is not None else cpus
+
+
+def cgroup_memory(root: str = CGROUP_ROOT) -> Optional[int]:
+    '''
+    The memory limit of the cgroup, the tightest of the cgroup and its ancestors, None if there is no limit.
+    '''
+    limits = []
+    for directory in cgroup_dirs("memory", root):
+        text = read_text(path.join(directory, "memory.max")) or read_text(path.join(directory, "memory.limit_in_bytes"))
+        if text is None or text == "max" or int(text) >= NO_LIMIT:
+            continue
+        limits.append(int(text))
+    return min(limits) if limits else None
+
+
+def available_memory() -> int:
+    '''
+    The memory this process can use, the cgroup limit if it has one, or what's available on the host when started,
+    which leaves out the memory taken by the other jobs on it.
+    '''
+    limits = [x for x in [cgroup_memory()] if x is not None]
+    for line in (read_text("/proc/meminfo") or "").splitlines():
+        if line.startswith("MemAvailable:"):
+            limits.append(int(line.split()[1]) * 1024)
+    return min(limits) if limits else 0
+
+
+def granted_memory(default: int = 0) -> int:
+    '''
+    The memory granted to the running stage by the scheduler, or the default if it's not bounded,
+    for the tools to spill to disk beyond it.
+    '''
+    return current_memory.get() or default
+
+
+def split_threads(threads: int, weights: Dict[str, float]) -> Dict[str, int]:
+    '''
+    Split the threads among the tools by their weights, by the largest remainder method.
+
+    Each tool gets a thread at least, taken from the tool with the most, so there are more threads than given
+    only if there are more tools. The ties of the remainders go to the tools first given.
+    '''
+    if not weights:
+        return {}
+    total = sum(weights.values())
+    quotas = {k: threads * v / total if total > 0 else threads / len(weights) for k, v in weights.items()}
+    allocation = {k: int(v) for k, v in quotas.items()}
+    left = threads - sum(allocation.values())
+    for name in sorted(quotas, key=lambda x: allocation[x] - quotas[x])[:left]:
+        allocation[name] += 1
+    for name in [k for k, v in allocation.items() if not v]:
+        most = max(allocation, key=lambda x: allocation[x])
+        if allocation[most] > 1:
+            allocation[most] -= 1
+        allocation[name] = 1
+    return allocation
+
+
+class Allocator():
+    '''
+    Split the threads of a stage among the tools it runs at the same time, like the ones of a pipeline,
+    by the weights of the tools, the tools without one weigh 1.
+
+    The allocation is recorded to the profile of the running stage, so it's in the run report.
+    '''
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None) -> None:
+        self.weights = dict(weights or {})
+
+    def split(self, threads: int, tools: Iterable[str]) -> Dict[str, int]:
+        allocation = split_threads(threads, {x: self.weights.get(x, 1) for x in tools})
+        record_allocation(allocation)
+        return allocation
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+from contextvars import ContextVar
+from os import path
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from wdp.runner.profiler import mark_stage, run_in_thread
+
+
+def fingerprint(file: str, content: bool = False) -> Optional[dict]:
+    '''
+    Describe a file by its size and mtime, and optionally by the hash of its content.
+
+    Returns None if the file does not exist.
+    '''
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return None
+    result = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if content:
+        digest = hashlib.sha1()
+        with open(file, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+        result["sha1"] = digest.hexdigest()
+    return result
+
+
+def checksum(file: str) -> Optional[str]:
+    '''
+    The crc32 of a file in hex, None if the file does not exist.
+    '''
+    if not path.isfile(file):
+        return None
+    crc = 0
+    with open(file, "rb") as f:
+        while chunk := f.read(1 << 20):
+            crc = zlib.crc32(chunk, crc)
+    return f"{crc:08x}"
+
+
+# the outputs of the stage running in the current task, mapped to the paths they are written to
+current_partials: ContextVar[Optional[Dict[str, str]]] = ContextVar("current_partials", default=None)
+
+
+def partial(file: str) -> str:
+    '''
+    The path to write an output of the running stage to,
+    it's renamed to the output only once the stage succeeds.
+
+    Files which are not outputs of the running stage are returned as they are.
+    '''
+    partials = current_partials.get()
+    if partials is None or file not in partials:
+        return file
+    return partials[file]
+
+
+def discard(files: Iterable[str]):
+    for file in files:
+        if path.isfile(file):
+            os.remove(file)
+
+
+async def atomic(fn: Callable[[], Awaitable], outputs: Iterable[str]):
+    '''
+    Run the stage with its outputs written to `.partial.` prefixed files, and rename them to the outputs
+    if `fn` returns a falsy value, so an output is either complete or not there at all.
+    '''
+    # prefixed, so the tools still tell the format from the suffix, like `.gz`
+    partials = {x: path.join(path.dirname(x), f".partial.{path.basename(x)}") for x in outputs}
+    # left by a run that was killed
+    discard(partials.values())
+    token = current_partials.set(partials)
+    try:
+        result = await fn()
+    except BaseException:
+        discard(partials.values())
+        raise
+    finally:
+        current_partials.reset(token)
+
+    if result:
+        discard(partials.values())
+        return result
+    for output, temp in partials.items():
+        if path.isfile(temp):
+            os.replace(temp, output)
+    return result
+
+
+class StageCache():
+    '''
+    A manifest of the finished stages in a working directory.
+
+    A stage is keyed by the fingerprints of its inputs and its parameters,
+    it will be skipped if the key is unchanged and its recorded outputs are untouched.
+
+    The record of a stage is its completion marker, written only after its outputs are in place,
+    with the checksums of the outputs. To resume, the outputs are also checked against their checksums,
+    so a stage is trusted only if its outputs are exactly the ones it wrote.
+    '''
+
+    def __init__(self, manifest: str, content: bool = False, enabled: bool = True, resume: bool = False) -> None:
+        self.manifest = manifest
+        self.content = content
+        self.enabled = enabled
+        self.resume = resume
+        self.stages: Dict[str, dict] = {}
+        if path.isfile(manifest):
+            with open(manifest) as f:
+                self.stages = json.load(f)
+
+    def released(self, file: str) -> Optional[dict]:
+        '''
+        The fingerprint of a temporary output when it was deleted, None if it's not.
+        '''
+        for record in self.stages.values():
+            if file in record.get("released", {}):
+                return record["released"][file]
+        return None
+
+    def key(self, inputs: Iterable[str], params: dict, upstream: Optional[Dict[str, str]] = None) -> str:
+        '''
+        The key of a stage by its inputs and parameters, and the keys of the stages writing the pipes it reads.
+        '''
+        # a deleted temporary input is taken as the one it was
+        inputs = [(x, fingerprint(x, self.content) or self.released(x)) for x in inputs]
+        key = {"inputs": inputs, "params": params}
+        if upstream:
+            key["pipes"] = upstream
+        encoded = json.dumps(key, sort_keys=True)
+        return hashlib.sha1(encoded.encode()).hexdigest()
+
+    def hit(self, stage: str, key: str) -> bool:
+        record = self.stages.get(stage)
+        if not self.enabled or record is None or record["key"] != key:
+            return False
+        released = record.get("released", {})
+        return all(fingerprint(k) == v or (k in released and not path.exists(k)) for k, v in record["outputs"].items())
+
+    def release(self, temp: str):
+        '''
+        Remember the outputs at or under the temporary path before they are deleted,
+        so the stages producing and reading them are still taken as finished.
+        '''
+        changed = False
+        for record in self.stages.values():
+            for output in record["outputs"]:
+                if (output == temp or output.startswith(temp + os.sep)) and path.exists(output):
+                    record.setdefault("released", {})[output] = fingerprint(output, self.content)
+                    changed = True
+        if changed:
+            self.save()
+
+    def verify(self, stage: str) -> bool:
+        '''
+        Check the outputs of a recorded stage against their checksums.
+        '''
+        checksums = self.stages[stage].get("checksums", {})
+        released = self.stages[stage].get("released", {})
+        return all(checksums.get(x) == checksum(x) for x in self.stages[stage]["outputs"] if x not in released)
+
+    def invalidate(self, stage: str):
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+    def record(self, stage: str, key: str, outputs: Iterable[str], checksums: Dict[str, Optional[str]] = {}):
+        self.stages[stage] = {"key": key,
+                              "outputs": {x: fingerprint(x) for x in outputs},
+                              "checksums": dict(checksums),
+                              "completed": time.time()}
+        self.save()
+
+    def save(self):
+        temp = self.manifest + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.stages, f, indent=2)
+        os.replace(temp, self.manifest)
+
+    async def run(self, stage: str, fn: Callable[[], Awaitable], key: str, outputs: Iterable[str]):
+        '''
+        Run the stage unless a previous run with the same key is recorded.
+
+        The stage is recorded only if `fn` returns a falsy value, like a zero exit code.
+        '''
+        outputs = list(outputs)
+        if self.hit(stage, key):
+            if not self.resume:
+                print(f"Skipping {stage}, the inputs are unchanged.")
+                mark_stage("cached")
+                return None
+            if await run_in_thread(self.verify, stage):
+                print(f"Skipping {stage}, it's completed and its outputs are intact.")
+                mark_stage("cached")
+                return None
+            print(f"Resuming from {stage}, its outputs do not match the checksums.")
+        self.invalidate(stage)
+        result = await fn()
+        if not result:
+            checksums = await run_in_thread(lambda: {x: checksum(x) for x in outputs})
+            self.record(stage, key, outputs, checksums)
+        return result
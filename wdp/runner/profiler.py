@@ -0,0 +1,166 @@
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional
+
+from wdp.util.formatter import ColorEnum, Component, Line, MultiLine
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def total_size(files: Iterable[str]) -> int:
+    return sum(os.path.getsize(x) for x in files if os.path.isfile(x))
+
+
+class StageProfile():
+    '''
+    The resources used by a stage, by the python threads working for it
+    and by each process it started.
+    '''
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.status = "running"
+        self.threads = 0
+        # the memory granted by the scheduler, 0 if not bounded
+        self.memory = 0
+        self.elapsed = 0.0
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.max_rss = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.processes: List[dict] = []
+        # the threads of the stage split among the tools it runs
+        self.allocation: Dict[str, int] = {}
+
+    @property
+    def cpu_time(self) -> float:
+        return self.user_time + self.system_time + sum(x["user_time"] + x["system_time"] for x in self.processes)
+
+    def to_dict(self) -> dict:
+        return {**vars(self), "cpu_time": self.cpu_time}
+
+
+# the stage running in the current task, so the processes started by it are recorded to it
+current_stage: ContextVar[Optional[StageProfile]] = ContextVar("current_stage", default=None)
+
+
+def record_process(stats: dict):
+    stage = current_stage.get()
+    if stage is not None:
+        stage.processes.append(stats)
+
+
+def record_allocation(allocation: Dict[str, int]):
+    stage = current_stage.get()
+    if stage is not None:
+        stage.allocation.update(allocation)
+
+
+def mark_stage(status: str):
+    stage = current_stage.get()
+    if stage is not None:
+        stage.status = status
+
+
+async def run_in_thread(fn: Callable, *args):
+    '''
+    Run the function in the default executor, with the CPU time of the thread counted to the current stage.
+    '''
+    stage = current_stage.get()
+
+    def measured():
+        before = resource.getrusage(resource.RUSAGE_THREAD)
+        try:
+            return fn(*args)
+        finally:
+            after = resource.getrusage(resource.RUSAGE_THREAD)
+            if stage is not None:
+                stage.user_time += after.ru_utime - before.ru_utime
+                stage.system_time += after.ru_stime - before.ru_stime
+                # the peak of the whole process, the threads share it
+                stage.max_rss = max(stage.max_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+    return await asyncio.get_event_loop().run_in_executor(None, measured)
+
+
+class Profiler():
+    '''
+    The profiles of the stages in a run, saved as a JSON report.
+    '''
+
+    def __init__(self, report: str = None) -> None:
+        self.report = report
+        self.started = time.time()
+        self.stages: Dict[str, StageProfile] = {}
+
+    @contextmanager
+    def stage(self, name: str, inputs: Iterable[str] = (), outputs: Iterable[str] = (), threads: int = 1, memory: int = 0):
+        profile = self.stages[name] = StageProfile(name)
+        profile.threads = threads
+        profile.memory = memory
+        token = current_stage.set(profile)
+        started = time.monotonic()
+        try:
+            yield profile
+            if profile.status == "running":
+                profile.status = "done"
+        except BaseException:
+            profile.status = "failed"
+            raise
+        finally:
+            current_stage.reset(token)
+            profile.elapsed = time.monotonic() - started
+            profile.input_bytes = total_size(inputs)
+            profile.output_bytes = total_size(outputs)
+
+    def to_dict(self) -> dict:
+        return {"command": sys.argv,
+                "started": self.started,
+                "elapsed": time.time() - self.started,
+                "stages": [x.to_dict() for x in self.stages.values()]}
+
+    def save(self):
+        if self.report is None:
+            return
+        temp = self.report + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(temp, self.report)
+
+    def summary(self) -> MultiLine:
+        report = self.to_dict()
+        summary = MultiLine(Line(Component(f"Finished in {report['elapsed']:.1f}s", ColorEnum.BOLD)))
+        for stage in self.stages.values():
+            color = ColorEnum.FOREGROUND_RED if stage.status == "failed" else ColorEnum.FOREGROUND_GREEN
+            summary.append(MultiLine(Line(Component(stage.name, ColorEnum.BOLD),
+                                          Component(f" {stage.status}", color),
+                                          Component(f", {stage.threads} threads"
+                                                    + (f", granted {format_bytes(stage.memory)}" if stage.memory else "")
+                                                    + f", {stage.elapsed:.1f}s, cpu {stage.cpu_time:.1f}s"
+                                                    f", in {format_bytes(stage.input_bytes)}"
+                                                    f", out {format_bytes(stage.output_bytes)}"
+                                                    + (f", python max rss {format_bytes(stage.max_rss)}" if stage.max_rss else "")
+                                                    + (f" ({', '.join(f'{k} {v}' for k, v in stage.allocation.items())})"
+                                                       if stage.allocation else ""))),
+                                     ident=1))
+            for process in stage.processes:
+                line = (f"{os.path.basename(process['argv'][0])}: exit {process['returncode']}, {process['elapsed']:.1f}s"
+                        f", cpu {process['user_time'] + process['system_time']:.1f}s, max rss {format_bytes(process['max_rss'])}")
+                if process["bytes_out"] is not None:
+                    rate = process["bytes_out"] / max(process["relay_time"], 1e-6)
+                    line += f", piped {format_bytes(process['bytes_out'])} at {format_bytes(rate)}/s"
+                summary.append(MultiLine(Line(Component(line)), ident=2))
+        return summary
@@ -0,0 +1,378 @@
+import asyncio
+import os
+from os import path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Union
+
+from wdp.runner.allocator import current_memory
+from wdp.runner.cache import StageCache, atomic
+from wdp.runner.profiler import Profiler, total_size
+from wdp.runner.scratch import Scratch
+
+
+class Stage():
+    '''
+    A step of a workflow, it's ready once all the stages producing its inputs are finished.
+
+    The `fn` is called with the number of threads granted to the stage,
+    it should write each output to `partial(output)`, which is renamed to the output once it succeeds.
+
+    The `memory` is the estimated peak memory of the stage in bytes, or a function estimating it
+    from the total size of the inputs in bytes.
+    '''
+
+    def __init__(self,
+                 name: str,
+                 fn: Callable[[int], Awaitable],
+                 inputs: Iterable[str] = (),
+                 outputs: Iterable[str] = (),
+                 after: Iterable[str] = (),
+                 threads: int = 1,
+                 params: Optional[dict] = None,
+                 group: Optional[str] = None,
+                 memory: Union[int, Callable[[int], int]] = 0) -> None:
+        self.name = name
+        self.fn = fn
+        self.inputs = [x for x in inputs if x]
+        self.outputs = [x for x in outputs if x]
+        self.after = list(after)
+        self.threads = max(threads, 1)
+        self.params = params
+        self.group = group
+        self.memory = memory
+        self.result = None
+
+
+class Group():
+    '''
+    A view of the scheduler that names its stages under a group,
+    and caps the threads each of them can ask for.
+    '''
+
+    def __init__(self, scheduler: "Scheduler", name: str, threads: Optional[int] = None) -> None:
+        self.scheduler = scheduler
+        self.name = name
+        self.threads = threads
+
+    def add(self, name: str, fn: Callable[[int], Awaitable], **kwargs) -> Stage:
+        kwargs["after"] = [f"{self.name}/{x}" for x in kwargs.get("after", ())]
+        if self.threads is not None:
+            kwargs["threads"] = min(kwargs.get("threads", 1), self.threads)
+        return self.scheduler.add(f"{self.name}/{name}", fn, group=self.name, **kwargs)
+
+
+class Scheduler():
+    '''
+    Run the stages by their dependencies on the current event loop.
+
+    Ready stages are started concurrently as long as the thread budget allows,
+    a stage gets the threads it asks for, or whatever is left if others are running.
+    At most `max_groups` groups of stages can be in progress at the same time.
+
+    With a `memory` budget, a stage starts only if its estimated memory fits in what's left of it,
+    unless nothing else is running, and it's granted the estimate within the budget.
+
+    Each stage is profiled, and the report is saved once the run ends, finished or not.
+
+    The temporary files in the scratch are released once all the stages reading them are finished,
+    and the stages writing to it wait while it's over its budget, unless nothing else is running.
+    The pipes of the scratch are made FIFOs, and the stages reading them start with the stage writing them.
+    '''
+
+    def __init__(self, threads: int, cache: StageCache = None, max_groups: Optional[int] = None,
+                 profiler: Profiler = None, scratch: Scratch = None, memory: int = 0) -> None:
+        self.threads = max(threads, 1)
+        self.memory = memory
+        self.cache = cache
+        self.max_groups = max_groups
+        self.profiler = profiler or Profiler()
+        self.scratch = scratch
+        self.stages: Dict[str, Stage] = {}
+        self.pipes: Set[str] = set()
+        self.readers: Dict[str, List[str]] = {}
+
+    def add(self, name: str, fn: Callable[[int], Awaitable], **kwargs) -> Stage:
+        if name in self.stages:
+            raise ValueError(f"Stage {name} is already added.")
+        self.stages[name] = Stage(name, fn, **kwargs)
+        return self.stages[name]
+
+    def group(self, name: str, threads: Optional[int] = None) -> Group:
+        return Group(self, name, threads)
+
+    def producers(self) -> Dict[str, str]:
+        producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f"\"{output}\" is produced by both {producers[output]} and {stage.name}.")
+                producers[output] = stage.name
+        return producers
+
+    def dependencies(self) -> Dict[str, Set[str]]:
+        producers = self.producers()
+        deps = {}
+        for stage in self.stages.values():
+            unknown = [x for x in stage.after if x not in self.stages]
+            if unknown:
+                raise ValueError(f"Stage {stage.name} is after unknown stages {unknown}.")
+            deps[stage.name] = {producers[x] for x in stage.inputs if x in producers} | set(stage.after)
+        return deps
+
+    def order(self) -> List[str]:
+        '''
+        The stages in a topological order, raises if the dependencies have a cycle.
+        '''
+        deps = self.dependencies()
+        ordered, done = [], set()
+        while len(ordered) < len(deps):
+            ready = [k for k, v in deps.items() if k not in done and v <= done]
+            if not ready:
+                raise ValueError(f"Stages {[k for k in deps if k not in done]} have cyclic dependencies.")
+            ordered += ready
+            done |= set(ready)
+        return ordered
+
+    def estimate(self, name: str) -> int:
+        '''
+        The estimated memory of the stage within the budget, by the inputs written so far, the pipes count none.
+        '''
+        stage = self.stages[name]
+        memory = stage.memory(total_size(x for x in stage.inputs if x not in self.pipes)) \
+            if callable(stage.memory) else stage.memory
+        return min(max(int(memory), 0), self.memory) if self.memory else 0
+
+    def key(self, name: str) -> str:
+        '''
+        The cache key of the stage, a pipe has no fingerprint, so the pipes it reads are keyed by
+        the keys of the stages writing them.
+        '''
+        stage = self.stages[name]
+        producers = self.producers()
+        inputs = [x for x in stage.inputs if x not in self.pipes]
+        upstream = {x: self.key(producers[x]) for x in stage.inputs if x in self.pipes}
+        return self.cache.key(inputs, stage.params, upstream)
+
+    async def execute(self, stage: Stage, threads: int, upstream: Iterable[asyncio.Task] = (), memory: int = 0):
+        # the pipes are neither renamed nor cached, they are run again with the other end
+        outputs = [x for x in stage.outputs if x not in self.pipes]
+
+        async def fn():
+            current_memory.set(memory)
+            result = await stage.fn(threads)
+            # what is read from a pipe is complete only if the stage writing it succeeds
+            for task in upstream:
+                await asyncio.shield(task)
+            return result
+
+        with self.profiler.stage(stage.name, stage.inputs, stage.outputs, threads, memory):
+            # the outputs are renamed into place before the stage is recorded as completed
+            def run():
+                return atomic(fn, outputs)
+
+            if self.cache is None or stage.params is None:
+                stage.result = await run()
+            else:
+                stage.result = await self.cache.run(stage.name, run,
+                                                    key=self.key(stage.name),
+                                                    outputs=outputs)
+        return stage.result
+
+    async def run(self) -> Dict[str, Any]:
+        try:
+            return await self.run_stages()
+        finally:
+            self.profiler.save()
+            print(self.profiler.summary())
+
+    def piped(self, readers: Dict[str, List[str]]) -> Set[str]:
+        '''
+        The pipes of the scratch which have both ends in the scheduler, the others are left as files.
+
+        Raises if a stage reading a pipe has to wait for the stage writing it, or for any stage
+        writing the pipes it reads, to finish, as they would block each other forever.
+        '''
+        if self.scratch is None:
+            return set()
+        producers = self.producers()
+        # a FIFO has one reader, or the readers would split the stream
+        pipes = {x for x in self.scratch.pipes if len(readers.get(x, ())) == 1 and x in producers}
+
+        deps = self.dependencies()
+        ancestors: Dict[str, Set[str]] = {}
+        for name in self.order():
+            ancestors[name] = set(deps[name]).union(*(ancestors[x] for x in deps[name]))
+        for pipe in pipes:
+            writers, queue = set(), [producers[pipe]]
+            while queue:
+                writers.add(name := queue.pop())
+                queue += [producers[x] for x in self.stages[name].inputs if x in pipes and producers[x] not in writers]
+            for reader in readers[pipe]:
+                waits = deps[reader] - {producers[x] for x in self.stages[reader].inputs if x in pipes}
+                blocking = waits.union(*(ancestors[x] for x in waits))
+                if writers & blocking:
+                    raise ValueError(f"Stage {reader} cannot read the pipe \"{pipe}\", "
+                                     f"it waits for {sorted(writers & blocking)} to finish.")
+        return pipes
+
+    def reclaim(self) -> Set[str]:
+        '''
+        Run again the stages whose temporary outputs are deleted, but needed by the stages to run,
+        and run both ends of a pipe if any of them runs.
+
+        Returns the stages to run, their records are dropped so none of them is skipped.
+        '''
+        if self.cache is None:
+            return set(self.stages)
+        producers = self.producers()
+        to_run = set()
+        for name in self.order():
+            stage = self.stages[name]
+            # a stage producing an input again changes it, the ones it's only after do not
+            if stage.params is None or any(producers.get(x) in to_run for x in stage.inputs) \
+                    or not self.cache.hit(name, self.key(name)):
+                to_run.add(name)
+
+        def force(name: str, reason: str):
+            print(f"Running {name} again, {reason}.")
+            to_run.add(name)
+            queue.append(name)
+
+        queue = list(to_run)
+        while queue:
+            name = queue.pop()
+            for file in self.stages[name].inputs:
+                producer = producers.get(file)
+                if producer is None or producer in to_run:
+                    continue
+                if file in self.pipes:
+                    force(producer, f"it writes the pipe \"{file}\" read by {name}")
+                elif self.scratch is not None and self.scratch.owner(file) is not None and not path.exists(file):
+                    force(producer, f"its temporary output \"{file}\" is deleted")
+            for pipe in set(self.stages[name].outputs) & self.pipes:
+                for reader in self.readers[pipe]:
+                    if reader not in to_run:
+                        force(reader, f"it reads the pipe \"{pipe}\" written by {name}")
+        for name in to_run:
+            self.cache.invalidate(name)
+        return to_run
+
+    def unblock(self, pipes: Iterable[str]):
+        '''
+        Open and close both ends of the pipes, so the stages stuck on opening them go on and fail.
+        '''
+        for pipe in pipes:
+            fds = []
+            try:
+                fds.append(os.open(pipe, os.O_RDONLY | os.O_NONBLOCK))
+                fds.append(os.open(pipe, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            for fd in fds:
+                os.close(fd)
+
+    def release(self, temp: str):
+        if self.cache is not None:
+            self.cache.release(temp)
+        self.scratch.release(temp)
+
+    def writes_scratch(self, name: str) -> bool:
+        return self.scratch is not None and any(self.scratch.owner(x) for x in self.stages[name].outputs)
+
+    async def run_stages(self) -> Dict[str, Any]:
+        deps = self.dependencies()
+        self.order()
+        readers = self.scratch.consumers({k: v.inputs for k, v in self.stages.items()}) if self.scratch else {}
+        unread = [k for k, v in readers.items() if not v]
+        self.readers = {k: list(v) for k, v in readers.items()}
+        self.pipes = self.piped(readers)
+        to_run = self.reclaim()
+
+        # the ends of the pipes to run are started together, the others wait as if they were files
+        producers = self.producers()
+        fifos = {x for x in self.pipes if producers[x] in to_run}
+        for fifo in fifos:
+            if path.lexists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+        upstream = {k: {producers[x] for x in v.inputs if x in fifos} for k, v in self.stages.items()}
+        waits = {k: v - upstream[k] for k, v in deps.items()}
+
+        available = self.threads
+        free_memory = self.memory
+        pending = list(self.stages)
+        finished: Set[str] = set()
+        tasks: Dict[str, asyncio.Task] = {}
+        running: Dict[asyncio.Task, tuple] = {}
+        remaining = {}
+        for stage in self.stages.values():
+            remaining[stage.group] = remaining.get(stage.group, 0) + 1
+        active: Set[str] = set()
+
+        try:
+            while pending or running:
+                started = True
+                # again after starting a stage, the stages reading its pipes start right away
+                while started:
+                    started = False
+                    ready = [x for x in pending if waits[x] <= finished and upstream[x] <= set(tasks)]
+                    # finish the groups in progress before starting new ones
+                    ready.sort(key=lambda x: self.stages[x].group not in active)
+                    full = self.scratch is not None and self.scratch.full()
+                    for name in ready:
+                        # the reader of a running pipe must start, or the writer blocks
+                        piped = bool(upstream[name])
+                        if available <= 0 and not piped:
+                            continue
+                        if full and running and self.writes_scratch(name) and not piped:
+                            continue
+                        # the cached ones only check their outputs
+                        memory = self.estimate(name) if name in to_run else 0
+                        if memory and memory > free_memory and running and not piped:
+                            continue
+                        group = self.stages[name].group
+                        if group is not None and group not in active:
+                            if self.max_groups is not None and len(active) >= self.max_groups and not piped:
+                                continue
+                            active.add(group)
+                        threads = max(min(self.stages[name].threads, available), 1 if piped else 0)
+                        available -= threads
+                        free_memory -= memory
+                        pending.remove(name)
+                        tasks[name] = asyncio.ensure_future(
+                            self.execute(self.stages[name], threads, [tasks[x] for x in upstream[name]], memory))
+                        running[tasks[name]] = (name, threads, memory)
+                        started = True
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name, threads, memory = running.pop(task)
+                    available += threads
+                    free_memory += memory
+                    if task.exception() is not None:
+                        for other in running:
+                            other.cancel()
+                        self.unblock(fifos)
+                        await asyncio.gather(*running, return_exceptions=True)
+                        raise task.exception()
+                    finished.add(name)
+                    group = self.stages[name].group
+                    remaining[group] -= 1
+                    if not remaining[group]:
+                        active.discard(group)
+                    for temp, stages in readers.items():
+                        if name in stages:
+                            stages.remove(name)
+                            if not stages:
+                                self.release(temp)
+        finally:
+            for fifo in fifos:
+                if path.lexists(fifo) and not path.isfile(fifo):
+                    os.remove(fifo)
+
+        if self.scratch is not None:
+            # the unread ones are moved out of the scratch
+            for temp in unread:
+                if self.cache is not None and self.scratch.temps[temp] != temp:
+                    self.cache.release(temp)
+            self.scratch.cleanup(unread)
+        return {k: v.result for k, v in self.stages.items()}
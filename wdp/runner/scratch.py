@@ -0,0 +1,133 @@
+import hashlib
+import os
+import shutil
+from os import path
+from typing import Dict, Iterable, List, Optional, Set
+
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text: str) -> int:
+    '''
+    Parse a size like `512M` or `16G` into bytes, 0 stands for no limit.
+    '''
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1:] if text[-1:] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def disk_usage(file: str) -> int:
+    if path.isdir(file):
+        return sum(disk_usage(x.path) for x in os.scandir(file))
+    return path.getsize(file) if path.isfile(file) else 0
+
+
+def remove(file: str):
+    if path.isdir(file):
+        shutil.rmtree(file, ignore_errors=True)
+    elif path.lexists(file):
+        os.remove(file)
+
+
+class Scratch():
+    '''
+    The temporary files of a run, which are put on a fast local directory if there is one.
+
+    A temporary file is deleted once the last stage reading it finishes, the ones not read by
+    any stage are the outputs of the run, and moved to where they would be in the working directory.
+    With `keep`, all of them are moved instead of deleted.
+
+    A file under a temporary directory is temporary too. A pipe is a temporary file never on disk,
+    but a FIFO between the stage writing it and the only stage reading it.
+    '''
+
+    def __init__(self, work_dir: str, scratch_dir: Optional[str] = None, budget: int = 0, keep: bool = False) -> None:
+        self.work_dir = path.abspath(work_dir)
+        # named by the working directory, so the files left by a killed run are found again
+        self.root = path.join(scratch_dir, "catk-" + hashlib.sha1(self.work_dir.encode()).hexdigest()[:12]) \
+            if scratch_dir else None
+        self.budget = budget
+        self.keep = keep
+        # the temporary paths to their final paths in the working directory
+        self.temps: Dict[str, str] = {}
+        # the temporary paths made FIFOs if both of their ends are run
+        self.pipes: Set[str] = set()
+
+    def temp(self, file: str) -> str:
+        '''
+        Declare a file or a directory in the working directory as temporary, returns the path to use instead.
+        '''
+        if self.root is None:
+            location = file
+        else:
+            location = path.join(self.root, path.relpath(path.abspath(file), self.work_dir))
+            os.makedirs(path.dirname(location), exist_ok=True)
+        self.temps[location] = file
+        return location
+
+    def pipe(self, file: str) -> str:
+        '''
+        Declare a temporary file streamed from the stage writing it to the stages reading it,
+        it's a plain file if the temporary files are kept.
+        '''
+        location = self.temp(file)
+        if not self.keep:
+            self.pipes.add(location)
+        return location
+
+    def owner(self, file: str) -> Optional[str]:
+        '''
+        The temporary path the file is, or is under, None if it's not temporary.
+        '''
+        for temp in self.temps:
+            if file == temp or file.startswith(temp + os.sep):
+                return temp
+        return None
+
+    def used(self) -> int:
+        return disk_usage(self.root) if self.root is not None else 0
+
+    def full(self) -> bool:
+        return bool(self.budget) and self.root is not None and self.used() >= self.budget
+
+    def release(self, temp: str):
+        '''
+        Delete a temporary file no longer needed, or move it to the working directory to keep it.
+        '''
+        if self.keep:
+            self.persist(temp)
+        else:
+            remove(temp)
+
+    def persist(self, temp: str):
+        final = self.temps[temp]
+        if temp == final or not path.lexists(temp):
+            return
+        remove(final)
+        os.makedirs(path.dirname(final), exist_ok=True)
+        shutil.move(temp, final)
+
+    def cleanup(self, unread: Iterable[str]):
+        '''
+        Move the temporary files read by no stage to the working directory, and release the others.
+
+        Only called once the run succeeds, a failed one leaves its files for the next run to resume from.
+        '''
+        unread = set(unread)
+        for temp in self.temps:
+            if temp in unread:
+                self.persist(temp)
+            else:
+                self.release(temp)
+        if self.root is not None:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def consumers(self, stages: Dict[str, Iterable[str]]) -> Dict[str, List[str]]:
+        '''
+        The stages reading each temporary path, by the inputs of the stages.
+        '''
+        result = {x: [] for x in self.temps}
+        for name, inputs in stages.items():
+            for temp in {self.owner(x) for x in inputs} - {None}:
+                result[temp].append(name)
+        return result
@@ -7,6 +7,12 @@ class UnsatisfiedError(Exception):
         self.unsats = args
 
 
+class BinaryNotFoundError(FileNotFoundError):
+    '''
+    A binary of the command is not found, reported as a usage error.
+    '''
+
+
 def throw_if_false(assertion: bool, error: Exception):
     if not assertion:
         raise error